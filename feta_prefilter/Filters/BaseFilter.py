@@ -1,25 +1,102 @@
+import logging
 from enum import IntEnum
+from typing import Callable, Iterable, NamedTuple
 
-import pygtrie
+from feta_prefilter.Filters.SuffixIndex import SuffixIndex
+from feta_prefilter.normalize import NormalizedBatch, normalize_domain
+
+logger = logging.getLogger(__name__)
 
 class FilterAction(IntEnum):
     PASS = 0
     DROP = 1
     STORE = 2
 
+class IndexExtension(NamedTuple):
+    """Entries added to the suffix index `previous` by `BaseFilter.add_suffixes`."""
+
+    previous: SuffixIndex
+    entries: list[tuple[str, ...]]
+
+
 class BaseFilter:
     def __init__(self, filter_name: str, filter_result_action=FilterAction.DROP):
         self.filter_name = filter_name
         self.filter_result_action = filter_result_action
 
-        self.suffix_trie = pygtrie.PrefixSet(factory=pygtrie.StringTrie, separator='.')
+        self.suffix_index = SuffixIndex()
+        # called with the filter and the `IndexExtension` (None if rebuilt) after its suffix index was swapped
+        self._index_listeners: list[Callable[["BaseFilter", "IndexExtension | None"], None]] = []
 
-    def filter(self, domains: list[str]) -> list[FilterAction]:
-        res = []
+    def load_suffixes(self, domains: Iterable[str]) -> None:
+        """Compiles the domains into a new suffix index and swaps it in."""
+        self.suffix_index = SuffixIndex.from_domains(domains)
+        self._notify_index_listeners(None)
+
+    def add_suffixes(self, domains: Iterable[str]) -> None:
+        """Inserts the domains into a copy of the suffix index and swaps it in.
+
+        Much cheaper than `load_suffixes` when a few domains are added to a
+        large list, but every call still copies the whole index, see
+        `SuffixIndex.extended`, and so does the pipeline for its combined index.
+        """
+        previous = self.suffix_index
+        entries = []
         for domain in domains:
-            reversed_domain = '.'.join(reversed(domain.strip().split('.')))
-            if reversed_domain.lower() in self.suffix_trie:
-                res.append(self.filter_result_action)
-            else:
-                res.append(FilterAction.PASS)
-        return res
+            domain = normalize_domain(domain)
+            if domain:
+                entries.append(tuple(reversed(domain.split("."))))
+        if not entries:
+            return
+
+        self.suffix_index = previous.extended(entries)
+        self._notify_index_listeners(IndexExtension(previous, entries))
+
+    def _notify_index_listeners(self, extension: "IndexExtension | None") -> None:
+        for listener in list(self._index_listeners):
+            try:
+                listener(self, extension)
+            except Exception:
+                logger.exception("Suffix index listener of filter %s failed", self.filter_name)
+
+    def add_index_listener(self, listener: Callable[["BaseFilter", "IndexExtension | None"], None]) -> None:
+        self._index_listeners.append(listener)
+
+    def remove_index_listener(self, listener: Callable[["BaseFilter", "IndexExtension | None"], None]) -> None:
+        if listener in self._index_listeners:
+            self._index_listeners.remove(listener)
+
+    def close(self) -> None:
+        """Called when the filter is removed from the configuration, e.g. to stop its background threads."""
+        pass
+
+    def prepare(self) -> None:
+        """Called before every evaluation of the filter, e.g. to refresh the suffix index."""
+        pass
+
+    def filter_batch(self, batch: NormalizedBatch) -> list[FilterAction]:
+        """Filters a normalized batch, filters with custom `filter` logic get the normalized names."""
+        if type(self).filter is not BaseFilter.filter:
+            return self.filter(batch.domains)
+        self.prepare()
+        action = self.filter_result_action
+        tags = self.suffix_index.match_labels_many(batch.labels)
+        return [action if tag else FilterAction.PASS for tag in tags]
+
+    def filter_sparse(self, batch: NormalizedBatch) -> list[tuple[int, FilterAction]]:
+        """Filters a normalized batch, returns the positions and actions of the domains that do not PASS.
+
+        The domains left out PASS. Filters that match few domains override this
+        to avoid the full-length result of `filter_batch`, which the default
+        implementation converts for filters with custom logic.
+        """
+        action = self.filter_result_action
+        if type(self).filter is BaseFilter.filter and type(self).filter_batch is BaseFilter.filter_batch:
+            self.prepare()
+            return [(i, action) for i in self.suffix_index.match_sparse(batch.labels)]
+        return [(i, action) for i, action in enumerate(self.filter_batch(batch)) if action != FilterAction.PASS]
+
+    def filter(self, domains: list[str]) -> list[FilterAction]:
+        self.prepare()
+        action = self.filter_result_action
+        return [action if tag else FilterAction.PASS for tag in self.suffix_index.match_many(domains)]
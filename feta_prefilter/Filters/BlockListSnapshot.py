@@ -0,0 +1,129 @@
+import mmap
+import os
+import struct
+from hashlib import blake2b
+from typing import Iterable
+
+from feta_prefilter.Filters.SuffixIndex import SuffixIndex
+from feta_prefilter.normalize import normalize_domain
+
+_MAGIC = b"FPSNAP01"
+# magic, number of entries, length of the entry data, digest of offsets and data
+_HEADER = struct.Struct("<8sQQ16s")
+_OFFSET = struct.Struct("<Q")
+# labels are joined with a byte that cannot occur in them, so that a parent
+# domain sorts right before all of its subdomains
+_SEPARATOR = b"\x00"
+
+
+def labels_key(labels: Iterable[str]) -> bytes:
+    """Encodes labels ordered from the TLD down, e.g. ``("com", "example", "www")`` as ``com\\0example\\0www``."""
+    return _SEPARATOR.join(label.encode() for label in labels)
+
+
+def snapshot_key(domain: str) -> bytes:
+    return labels_key(reversed(normalize_domain(domain).split(".")))
+
+
+def write_snapshot(path: str, domains: Iterable[str]) -> int:
+    """Compiles the domains into a snapshot file, returns the number of entries.
+
+    Entries covered by a parent domain are left out, so that the snapshot is
+    prefix-free and a single binary search finds the only candidate suffix.
+    """
+    index = SuffixIndex.from_domains(domains)
+    keys = sorted(labels_key(labels) for labels, _ in index.entries())
+
+    offsets = bytearray()
+    position = 0
+    for key in keys:
+        offsets += _OFFSET.pack(position)
+        position += len(key)
+    offsets += _OFFSET.pack(position)
+    data = b"".join(keys)
+
+    digest = blake2b(offsets, digest_size=16)
+    digest.update(data)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(keys), len(data), digest.digest()))
+        f.write(offsets)
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(keys)
+
+
+class BlockListSnapshot:
+    """Read-only, memory-mapped view of a compiled blocklist snapshot.
+
+    The snapshot holds the sorted reversed domains and an offset table. The file
+    is mapped, not read, so processes using the same snapshot share its pages
+    in the page cache and opening it is instant regardless of its size.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.size, data_len, self.digest = _HEADER.unpack_from(self._mmap)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a blocklist snapshot")
+        self._data_start = _HEADER.size + (self.size + 1) * _OFFSET.size
+        if len(self._mmap) != self._data_start + data_len:
+            raise ValueError(f"Blocklist snapshot {path} is truncated")
+        # the offsets are read in place, the cast relies on a little-endian host like the file format
+        self._offsets = memoryview(self._mmap)[_HEADER.size:self._data_start].cast("Q")
+
+    def __len__(self) -> int:
+        return self.size
+
+    def close(self) -> None:
+        self._offsets.release()
+        self._mmap.close()
+
+    def __del__(self):
+        if hasattr(self, "_mmap") and not self._mmap.closed:
+            self.close()
+
+    def __reduce__(self):
+        # the snapshot is mapped again by the process it is sent to, sharing its pages
+        return BlockListSnapshot, (self.path,)
+
+    def match(self, domain: str) -> bool:
+        """Whether the domain or any of its parent domains is in the snapshot."""
+        return self.match_key(snapshot_key(domain))
+
+    def match_key(self, key: bytes) -> bool:
+        """Like `match`, but takes the domain encoded by `labels_key`."""
+        data = self._mmap
+        offsets = self._offsets
+        start = self._data_start
+
+        # find the greatest entry <= key, being prefix-free only that one can be a parent of the key
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[start + offsets[mid]:start + offsets[mid + 1]] <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return False
+
+        entry = data[start + offsets[lo - 1]:start + offsets[lo]]
+        return key == entry or (key.startswith(entry) and key[len(entry):len(entry) + 1] == _SEPARATOR)
+
+    def match_many(self, domains: Iterable[str]) -> list[bool]:
+        match = self.match
+        return [match(domain) for domain in domains]
+
+    def entries(self) -> Iterable[tuple[str, ...]]:
+        """Yields the reversed labels of every entry."""
+        data = self._mmap
+        offsets = self._offsets
+        start = self._data_start
+        for i in range(self.size):
+            key = data[start + offsets[i]:start + offsets[i + 1]]
+            yield tuple(label.decode() for label in key.split(_SEPARATOR))
@@ -1,15 +1,15 @@
 import logging
-import time
 from validators import country_code
 
 import requests
 
-from feta_prefilter.Filters.BaseFilter import BaseFilter, FilterAction
+from feta_prefilter.Filters.BaseFilter import FilterAction
+from feta_prefilter.Filters.RefreshingFilter import RefreshingFilter
 
 logger = logging.getLogger(__name__)
 
 
-class CloudflareTopFilter(BaseFilter):
+class CloudflareTopFilter(RefreshingFilter):
     """Filter using Cloudflare Radar Top domains."""
 
     def __init__(
@@ -21,10 +21,11 @@ class CloudflareTopFilter(BaseFilter):
             location: str | None = None,  # ISO Alpha-2 code of the target country, defaults to None = worldwide
             filter_result_action: FilterAction = FilterAction.DROP,
     ):
-        super().__init__(filter_name, filter_result_action)
+        super().__init__(filter_name, filter_result_action, refresh_interval_s=cache_time_s)
         assert api_token != "", "api_token must not be empty"
         assert top_n > 0, "top_n must be greater than 0"
-        assert cache_time_s >= 0, "cache_time_s must be a non-negative time in seconds"
+        # the list is refreshed in the background, 0 would query the API in a loop
+        assert cache_time_s > 0, "cache_time_s must be a positive time in seconds"
         if location is not None:
             assert country_code(location, iso_format='alpha2',
                                 ignore_case=True), "location must be a valid ISO 3166 alpha-2 country code"
@@ -33,41 +34,26 @@ class CloudflareTopFilter(BaseFilter):
         self.top_n = top_n
         self.cache_time = cache_time_s
         self.location = location
-        self._last_fetch = 0.0
-        self._fetch_domains()
+        self.start_refresh()
 
-    def _fetch_domains(self) -> None:
-        """Fetch top domains from Cloudflare Radar API and populate the trie."""
+    def fetch_all(self) -> tuple[list[str], None]:
+        """Fetch top domains from Cloudflare Radar API."""
         headers = {"Authorization": f"Bearer {self.api_token}"}
         url = "https://api.cloudflare.com/client/v4/radar/ranking/top"
         params = {"limit": self.top_n}
         if self.location:
             params["location"] = self.location
-        try:
-            response = requests.get(url, headers=headers, params=params, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            domains = []
-            result = data.get("result", {})
-            top_domains = result.get("top_0", [])
-            for item in top_domains:
-                domain = item.get("domain")
-                if domain:
-                    domains.append(domain)
-            if domains:
-                self.suffix_trie.clear()
-                for domain in domains:
-                    reversed_domain = ".".join(reversed(domain.strip().split(".")))
-                    self.suffix_trie.add(reversed_domain.lower())
-                self._last_fetch = time.time()
-                logger.info("Loaded %d domains from Cloudflare Radar", len(domains))
-        except Exception as e:  # pylint: disable=broad-except
-            logger.exception("Failed to fetch domains from Cloudflare Radar", exc_info=e)
 
-    def _ensure_fresh(self) -> None:
-        if time.time() - self._last_fetch > self.cache_time:
-            self._fetch_domains()
-
-    def filter(self, domains: list[str]) -> list[FilterAction]:
-        self._ensure_fresh()
-        return super().filter(domains)
+        response = requests.get(url, headers=headers, params=params, timeout=10)
+        response.raise_for_status()
+        data = response.json()
+        domains = []
+        result = data.get("result", {})
+        top_domains = result.get("top_0", [])
+        for item in top_domains:
+            domain = item.get("domain")
+            if domain:
+                domains.append(domain)
+        if not domains:
+            raise ValueError("Cloudflare Radar returned no domains")
+        return domains, None
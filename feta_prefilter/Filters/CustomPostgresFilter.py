@@ -1,16 +1,26 @@
 import logging
+import select
 from urllib.parse import urlparse
 
 import psycopg2
 from psycopg2 import sql
 
 from feta_prefilter.Filters.BaseFilter import FilterAction
-from feta_prefilter.Filters.BaseFilter import BaseFilter
+from feta_prefilter.Filters.RefreshingFilter import RefreshingFilter
 
 logger = logging.getLogger(__name__)
 
 
-class CustomPostgresFilter(BaseFilter):
+class CustomPostgresFilter(RefreshingFilter):
+    """Filters the domains of a custom prefilter stored in PostgreSQL.
+
+    With `updated_at_column`, a column of the domains table holding the time
+    of the last change of a row, refreshes fetch only the rows changed since
+    the previous fetch. Removed rows are only noticed by the full refresh every
+    `full_refresh_interval_s`. With `notify_channel`, the filter also listens
+    for PostgreSQL notifications on the channel and refreshes when one comes.
+    """
+
     def __init__(
         self,
         filter_name: str,
@@ -22,8 +32,12 @@ class CustomPostgresFilter(BaseFilter):
         filter_table_name: str,
         domains_table_name: str,
         filter_result_action=FilterAction.DROP,
+        refresh_interval_s: float | None = 600.0,
+        full_refresh_interval_s: float | None = 3600.0,
+        updated_at_column: str | None = None,
+        notify_channel: str | None = None,
     ):
-        super().__init__(filter_name, filter_result_action)
+        super().__init__(filter_name, filter_result_action, refresh_interval_s, full_refresh_interval_s)
         self.db_connection_info = {
             "database": database,
             "host": host,
@@ -33,33 +47,45 @@ class CustomPostgresFilter(BaseFilter):
         }
         self.filter_table_name = filter_table_name
         self.domains_table_name = domains_table_name
+        self.updated_at_column = updated_at_column
+        self.notify_channel = notify_channel
+        self._listen_conn = None
+
+        self.start_refresh()
 
-        domains = self.load_domains()
+    def fetch_all(self):
+        return self.load_domains()
 
-        for domain in domains:
-            reversed_domain = ".".join(reversed(domain.strip().split(".")))
-            self.suffix_trie.add(reversed_domain.lower())
+    def fetch_changes(self, since):
+        if self.updated_at_column is None:
+            return None
+        domains, next_since = self.load_domains(since)
+        return domains, [], next_since
 
-    def load_domains(self):
+    def load_domains(self, since=None) -> tuple[list[str], object]:
+        """Returns the domains changed since the time, all if None, and the database time of the query."""
+        command, param_list = self.build_query(since)
         try:
-            command, param_list = self.build_query()
             with psycopg2.connect(**self.db_connection_info) as conn:
                 with conn.cursor() as curr:
+                    # the transaction start time, rows changed later are fetched by the next query
+                    curr.execute("SELECT now()")
+                    now = curr.fetchone()[0]
                     curr.execute(
                         sql.SQL(command).format(
                             dt=sql.Identifier(self.domains_table_name),
                             ft=sql.Identifier(self.filter_table_name),
+                            updated_at=sql.Identifier(self.updated_at_column or "updated_at"),
                         ),
                         param_list,
                     )
-                    ret = [row[0] for row in curr.fetchall()]
-                    return ret
+                    return [row[0] for row in curr.fetchall()], now
         except Exception:
-            logger.exception("Exception raised while sending data to postgres")
             logger.error(f"Postgres command: {command}")
             logger.error(f"Postgres command params: {param_list}")
+            raise
 
-    def build_query(self) -> tuple[str, list]:
+    def build_query(self, since=None) -> tuple[str, list]:
         param_list = [self.filter_name]
 
         command = """
@@ -71,4 +97,45 @@ class CustomPostgresFilter(BaseFilter):
             ft.name = %s
             AND ft.enabled = false
         """
+        if since is not None:
+            command += "    AND dt.{updated_at} >= %s\n"
+            param_list.append(since)
         return command, param_list
+
+    def wait_for_change(self, timeout: float) -> None:
+        if self.notify_channel is None:
+            super().wait_for_change(timeout)
+            return
+
+        try:
+            conn = self._listen()
+            if select.select([conn], [], [], timeout) != ([], [], []):
+                conn.poll()
+                if conn.notifies:
+                    logger.debug("Filter %s notified of a change", self.filter_name)
+                    conn.notifies.clear()
+        except Exception:
+            logger.exception("Cannot listen for changes of filter %s", self.filter_name)
+            self._close_listen()
+            super().wait_for_change(timeout)
+
+    def close(self) -> None:
+        super().close()
+        self._close_listen()
+
+    def _listen(self):
+        if self._listen_conn is None:
+            conn = psycopg2.connect(**self.db_connection_info)
+            conn.autocommit = True
+            with conn.cursor() as curr:
+                curr.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.notify_channel)))
+            self._listen_conn = conn
+        return self._listen_conn
+
+    def _close_listen(self) -> None:
+        if self._listen_conn is not None:
+            try:
+                self._listen_conn.close()
+            except Exception:
+                pass
+            self._listen_conn = None
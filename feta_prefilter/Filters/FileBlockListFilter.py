@@ -1,12 +1,33 @@
 from feta_prefilter.Filters.BaseFilter import FilterAction
-from feta_prefilter.Filters.BaseFilter import BaseFilter
+from feta_prefilter.Filters.RefreshingFilter import RefreshingFilter
+from feta_prefilter.filewatch import read_appended_lines
 
 
-class FileBlockListFilter(BaseFilter):
-    def __init__(self, filter_name:str, filter_result_action=FilterAction.DROP, filename=""):
-        super().__init__(filter_name, filter_result_action)
+class FileBlockListFilter(RefreshingFilter):
+    """Filters the domains listed in a file, one per line.
 
-        with open(filename) as f:
-            for domain in f.readlines():
-                reversed_domain = '.'.join(reversed(domain.strip().split('.')))
-                self.suffix_trie.add(reversed_domain.lower())
+    The file is checked every `watch_interval_s` (None disables watching).
+    Lines appended to it are inserted into the suffix index, a file that was
+    replaced or rewritten is loaded again in the background and swapped in.
+    A file that cannot be read when the filter is created raises, later
+    failures keep the previous list.
+    """
+
+    keep_domains = False
+    require_initial_load = True
+
+    def __init__(self, filter_name:str, filter_result_action=FilterAction.DROP, filename="",
+                 watch_interval_s: float | None = 5.0):
+        super().__init__(filter_name, filter_result_action, refresh_interval_s=watch_interval_s)
+        self.filename = filename
+        self.start_refresh()
+
+    def fetch_all(self) -> tuple[list[str], dict]:
+        return read_appended_lines(self.filename, None)
+
+    def fetch_changes(self, since: dict) -> tuple[list[str], list[str], dict] | None:
+        appended = read_appended_lines(self.filename, since)
+        if appended is None:
+            return None
+        lines, position = appended
+        return lines, [], position
@@ -1,11 +1,19 @@
+import time
+from collections import Counter
 from urllib.parse import urlparse
 
 from pymisp import PyMISP
 
 from feta_prefilter.Filters.BaseFilter import FilterAction
-from feta_prefilter.Filters.BaseFilter import BaseFilter
+from feta_prefilter.Filters.RefreshingFilter import RefreshingFilter
+
+class MISPFilter(RefreshingFilter):
+    """Filters the domains of MISP attributes marked for IDS.
+
+    Refreshes fetch only the attributes changed since the previous fetch,
+    including the deleted ones and the ones no longer marked for IDS.
+    """
 
-class MISPFilter(BaseFilter):
     def __init__(
         self,
         filter_name: str,
@@ -13,21 +21,77 @@ class MISPFilter(BaseFilter):
         misp_key: str,
         misp_feed_eventids: list[int],
         filter_result_action=FilterAction.DROP,
+        refresh_interval_s: float | None = 3600.0,
+        full_refresh_interval_s: float | None = 86400.0,
     ):
-        super().__init__(filter_name, filter_result_action)
+        super().__init__(filter_name, filter_result_action, refresh_interval_s, full_refresh_interval_s)
 
         self.misp = PyMISP(misp_url, misp_key, ssl=False)
+        self.misp_feed_eventids = misp_feed_eventids
+        # domains of the current attributes by their UUID and the number of attributes of each domain
+        self._attribute_domains_by_uuid: dict[str, str] = {}
+        self._domain_counts: Counter = Counter()
+        # the same of the last fetch, adopted once its list is swapped in
+        self._fetched: tuple[dict[str, str], Counter] | None = None
+        self.start_refresh()
+
+    def fetch_all(self) -> tuple[list[str], int]:
+        since = int(time.time())
         attributes = self.misp.search(
-            controller="attributes", to_ids=True, eventid=misp_feed_eventids, pythonify=True
+            controller="attributes", to_ids=True, eventid=self.misp_feed_eventids, pythonify=True
         )
 
+        domains_by_uuid = {}
+        domain_counts = Counter()
         for attr in attributes:
-            if attr.type == "domain":
-                reversed_domain = '.'.join(reversed(attr.value.strip().split('.')))
-            elif attr.type == "url":
-                domain = urlparse(attr.value).netloc
-                reversed_domain = '.'.join(reversed(domain.strip().split('.')))
-            else:
-                continue
-
-            self.suffix_trie.add(reversed_domain.lower())
+            domain = self._attribute_domain(attr)
+            if domain:
+                domains_by_uuid[attr.uuid] = domain
+                domain_counts[domain] += 1
+        self._fetched = (domains_by_uuid, domain_counts)
+        return list(domain_counts), since
+
+    def fetch_changes(self, since: int) -> tuple[list[str], list[str], int]:
+        next_since = int(time.time())
+        attributes = self.misp.search(
+            controller="attributes",
+            eventid=self.misp_feed_eventids,
+            timestamp=since,
+            deleted=[0, 1],
+            pythonify=True,
+        )
+
+        # the changes are applied to copies, the list in use keeps its state until they are swapped in
+        domains_by_uuid = dict(self._attribute_domains_by_uuid)
+        domain_counts = Counter(self._domain_counts)
+        added = []
+        removed = []
+        for attr in attributes:
+            previous = domains_by_uuid.pop(attr.uuid, None)
+            if previous is not None:
+                domain_counts[previous] -= 1
+                if not domain_counts[previous]:
+                    del domain_counts[previous]
+                    removed.append(previous)
+
+            domain = self._attribute_domain(attr)
+            if domain and attr.to_ids and not getattr(attr, "deleted", False):
+                domains_by_uuid[attr.uuid] = domain
+                domain_counts[domain] += 1
+                added.append(domain)
+        self._fetched = (domains_by_uuid, domain_counts)
+        # a domain removed by one attribute may still be added by another one
+        return added, [domain for domain in removed if domain not in domain_counts], next_since
+
+    def commit_refresh(self) -> None:
+        if self._fetched is not None:
+            self._attribute_domains_by_uuid, self._domain_counts = self._fetched
+            self._fetched = None
+
+    @staticmethod
+    def _attribute_domain(attr) -> str | None:
+        if attr.type == "domain":
+            return attr.value
+        elif attr.type == "url":
+            return urlparse(attr.value).netloc
+        return None
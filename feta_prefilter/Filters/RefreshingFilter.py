@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+from typing import Any, Iterable
+
+from feta_prefilter.Filters.BaseFilter import BaseFilter, FilterAction
+
+logger = logging.getLogger(__name__)
+
+# lower bound of the delay between two refreshes
+MIN_REFRESH_INTERVAL_S = 1.0
+# first delay before retrying a failed refresh, doubled up to the refresh interval while it keeps failing
+MIN_RETRY_INTERVAL_S = 5.0
+
+
+class RefreshingFilter(BaseFilter):
+    """Base of filters whose domain list is kept in a remote service.
+
+    The list is loaded when the filter is created, then a background thread
+    refreshes it every `refresh_interval_s` or when `request_refresh` is called.
+    The new suffix index is built in the background thread and swapped in
+    atomically, the filters never wait for the remote service. When a refresh
+    fails, the previous list stays in use and the refresh is retried after
+    `MIN_RETRY_INTERVAL_S`, with the delay doubling up to `refresh_interval_s`
+    while it keeps failing.
+
+    Subclasses implement `fetch_all` and, if the service can tell what changed
+    since a given time, `fetch_changes`. Changes that only add domains are
+    inserted into a copy of the current index, see `add_suffixes`, removals
+    rebuild it. Incremental refreshes may miss some changes, e.g. deleted rows,
+    so the whole list is fetched again every `full_refresh_interval_s`.
+
+    Subclasses whose changes never remove domains set `keep_domains` to False,
+    so the list is not kept in memory next to the index. Subclasses whose list
+    must be available at startup, e.g. a local file, set `require_initial_load`,
+    so a failed initial load raises from the constructor.
+    """
+
+    keep_domains = True
+    require_initial_load = False
+
+    def __init__(
+        self,
+        filter_name: str,
+        filter_result_action=FilterAction.DROP,
+        refresh_interval_s: float | None = 3600.0,
+        full_refresh_interval_s: float | None = None,
+    ):
+        super().__init__(filter_name, filter_result_action)
+        self.refresh_interval_s = refresh_interval_s
+        self.full_refresh_interval_s = full_refresh_interval_s
+
+        self._domains: set[str] = set()
+        # position returned by the last successful fetch, incremental fetches continue from it
+        self._since: Any = None
+        self._last_full_refresh = 0.0
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._thread: threading.Thread | None = None
+        # refreshes failed in a row, retried sooner than `refresh_interval_s`
+        self._failures = 0
+
+    def fetch_all(self) -> tuple[Iterable[str], Any]:
+        """Returns all domains of the list and the position to fetch the next changes from."""
+        raise NotImplementedError()
+
+    def fetch_changes(self, since: Any) -> tuple[Iterable[str], Iterable[str], Any] | None:
+        """Returns the added and removed domains since the position and the next position.
+
+        None means that the service cannot tell the changes and the whole list
+        is fetched instead.
+        """
+        return None
+
+    def commit_refresh(self) -> None:
+        """Called once the list returned by the last fetch is in use.
+
+        Subclasses that track the fetched list to compute the next changes keep
+        the new state aside in the fetch methods and adopt it here, so a failed
+        refresh leaves the state of the list in use intact.
+        """
+
+    def start_refresh(self) -> None:
+        """Loads the list and starts the background refresh, called at the end of the constructor."""
+        if self.require_initial_load:
+            self._refresh(full=True)
+        elif not self.refresh(full=True):
+            self._failures = 1
+            logger.error("Filter %s starts without a list until a refresh succeeds", self.filter_name)
+        if self.refresh_interval_s is None or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._refresh_loop, name=f"refresh-{self.filter_name}", daemon=True)
+        self._thread.start()
+
+    def request_refresh(self) -> None:
+        """Makes the background thread refresh the list right away."""
+        self._wake.set()
+
+    def close(self) -> None:
+        self._closed.set()
+        self._wake.set()
+
+    def refresh(self, full: bool = False) -> bool:
+        """Fetches the list and swaps in the new index, returns False if the refresh failed."""
+        try:
+            self._refresh(full)
+        except Exception:
+            logger.exception("Failed to refresh filter %s, keeping the previous list", self.filter_name)
+            return False
+        return True
+
+    def _refresh(self, full: bool) -> None:
+        changes = None
+        if not full and self._since is not None:
+            changes = self.fetch_changes(self._since)
+
+        if changes is None:
+            full = True
+            domains, since = self.fetch_all()
+            domains = set(domains)
+            self.load_suffixes(domains)
+        else:
+            added, removed, since = changes
+            added = set(added)
+            removed = set(removed)
+            if not added and not removed:
+                self._since = since
+                self.commit_refresh()
+                return
+            if removed:
+                domains = (self._domains - removed) | added
+                self.load_suffixes(domains)
+            else:
+                domains = self._domains | added
+                self.add_suffixes(added)
+
+        if self.keep_domains:
+            self._domains = domains
+        self._since = since
+        self.commit_refresh()
+        if full:
+            self._last_full_refresh = time.monotonic()
+        logger.info("Refreshed filter %s with %d entries", self.filter_name, len(self.suffix_index))
+
+    def wait_for_change(self, timeout: float) -> None:
+        """Blocks until the next refresh is due, subclasses may also wait for change notifications."""
+        self._wake.wait(timeout)
+
+    def _refresh_loop(self) -> None:
+        while not self._closed.is_set():
+            self.wait_for_change(self._next_refresh_delay())
+            self._wake.clear()
+            if self._closed.is_set():
+                break
+
+            full = (
+                self.full_refresh_interval_s is not None
+                and time.monotonic() - self._last_full_refresh >= self.full_refresh_interval_s
+            )
+            if self.refresh(full=full):
+                self._failures = 0
+            else:
+                self._failures += 1
+                logger.warning(
+                    "Refresh %d of filter %s failed, retrying in %.0fs",
+                    self._failures, self.filter_name, self._next_refresh_delay(),
+                )
+
+    def _next_refresh_delay(self) -> float:
+        interval = max(self.refresh_interval_s, MIN_REFRESH_INTERVAL_S)
+        if not self._failures:
+            return interval
+        return min(MIN_RETRY_INTERVAL_S * 2 ** (self._failures - 1), interval)
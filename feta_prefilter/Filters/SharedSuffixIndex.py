@@ -0,0 +1,133 @@
+import mmap
+import os
+import struct
+from array import array
+from zlib import crc32
+
+from feta_prefilter.Filters.SuffixIndex import SuffixIndex
+
+_MAGIC = b"FPSHIX01"
+# magic, number of nodes, number of hash slots, number of labels, length of the label data, full tag
+_HEADER = struct.Struct("<8sQQQQQ")
+
+
+def write_shared_index(path: str, index: SuffixIndex) -> None:
+    """Writes the suffix index into a file that `SharedSuffixIndex` maps.
+
+    The edges of the trie are stored in an open-addressing hash table keyed by
+    the parent node and the label, so the file is looked up in place without
+    rebuilding any dict in the processes mapping it.
+    """
+    label_names, parents, labels, tags = index.tables()
+    encoded = [name.encode() for name in label_names]
+    num_nodes = len(tags)
+    # at most half of the slots are used, the root is never a child so 0 marks an empty slot
+    num_slots = 1 << max(3, (2 * num_nodes).bit_length())
+    mask = num_slots - 1
+
+    hashes = array("I", bytes(4 * num_nodes))
+    slots = array("I", bytes(4 * num_slots))
+    for node in range(1, num_nodes):
+        h = crc32(encoded[labels[node]], parents[node])
+        hashes[node] = h
+        slot = h & mask
+        while slots[slot]:
+            slot = (slot + 1) & mask
+        slots[slot] = node
+
+    data = b"".join(encoded)
+    data_start = _HEADER.size + 8 * (len(encoded) + 1) + 8 * num_nodes + 4 * (3 * num_nodes + num_slots)
+    offsets = array("Q", [data_start])
+    for label in encoded:
+        offsets.append(offsets[-1] + len(label))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, num_nodes, num_slots, len(encoded), len(data), index.full_tag))
+        # the 8-byte tables come first to keep every table aligned in the mapping
+        for table in (offsets, tags, hashes, parents, labels, slots):
+            table.tofile(f)
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class SharedSuffixIndex:
+    """Read-only, memory-mapped suffix index written by `write_shared_index`.
+
+    Matches like the `SuffixIndex` it was written from. The tables are read in
+    place, so every process mapping the file shares a single copy of them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, num_nodes, num_slots, num_labels, data_len, self.full_tag = _HEADER.unpack_from(self._mmap)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a shared suffix index")
+
+        # the tables are read in place, the casts rely on a little-endian host like the file format
+        view = memoryview(self._mmap)
+        position = _HEADER.size
+        self._tables = []
+        for fmt, count in (("Q", num_labels + 1), ("Q", num_nodes), ("I", num_nodes), ("I", num_nodes),
+                           ("I", num_nodes), ("I", num_slots)):
+            end = position + struct.calcsize(fmt) * count
+            self._tables.append(view[position:end].cast(fmt))
+            position = end
+        view.release()
+        if len(self._mmap) != position + data_len:
+            raise ValueError(f"Shared suffix index {path} is truncated")
+        self._offsets, self._tags, self._hashes, self._parents, self._labels, self._slots = self._tables
+
+    def close(self) -> None:
+        for table in self._tables:
+            table.release()
+        self._mmap.close()
+
+    def __del__(self):
+        if hasattr(self, "_mmap") and not self._mmap.closed:
+            self.close()
+
+    def memory_usage(self) -> int:
+        return len(self._mmap)
+
+    def match_sparse(self, labels: list[list[str]]) -> dict[int, int]:
+        """Returns the non-zero tags of the domains, given as labels ordered from the TLD down, by their positions."""
+        data = self._mmap
+        offsets = self._offsets
+        tags = self._tags
+        hashes = self._hashes
+        parents = self._parents
+        label_ids = self._labels
+        slots = self._slots
+        mask = len(slots) - 1
+        full_tag = self.full_tag
+
+        res = {}
+        for i, domain_labels in enumerate(labels):
+            node = 0
+            tag = 0
+            for label in domain_labels:
+                key = label.encode()
+                h = crc32(key, node)
+                slot = h & mask
+                child = slots[slot]
+                while child:
+                    if hashes[child] == h and parents[child] == node:
+                        label_id = label_ids[child]
+                        if data[offsets[label_id]:offsets[label_id + 1]] == key:
+                            break
+                    slot = (slot + 1) & mask
+                    child = slots[slot]
+                if not child:
+                    break
+                node = child
+                # tags are cumulative, the deepest reached node holds the union of the path
+                tag = tags[node]
+                if tag == full_tag:
+                    break
+            if tag:
+                res[i] = tag
+        return res
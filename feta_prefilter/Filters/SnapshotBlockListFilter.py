@@ -0,0 +1,58 @@
+import logging
+import os
+from typing import Sequence
+
+from feta_prefilter.Filters.BaseFilter import FilterAction
+from feta_prefilter.Filters.BaseFilter import BaseFilter
+from feta_prefilter.Filters.BlockListSnapshot import BlockListSnapshot, labels_key
+from feta_prefilter.Filters.SuffixBloom import SuffixBloom
+from feta_prefilter.normalize import NormalizedBatch, normalize_domain
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotBlockListFilter(BaseFilter):
+    """Blocklist filter backed by a memory-mapped snapshot.
+
+    The snapshot is compiled offline with ``prefilter-compile``. If the compiler
+    also wrote a pre-screen (``<snapshot>.bloom``), only the domains passing it
+    are looked up in the snapshot, which saves the binary searches of most
+    domains that do not match.
+    """
+
+    def __init__(self, filter_name: str, filter_result_action=FilterAction.DROP, snapshot: str = ""):
+        super().__init__(filter_name, filter_result_action)
+        self.snapshot = BlockListSnapshot(snapshot)
+        self.prescreen = SuffixBloom.load(f"{snapshot}.bloom", self.snapshot.digest)
+        if self.prescreen is None and os.path.exists(f"{snapshot}.bloom"):
+            logger.warning("Ignoring the pre-screen %s.bloom of another snapshot or version, compile it again", snapshot)
+        logger.info(
+            "Opened blocklist snapshot %s with %d entries%s",
+            snapshot, len(self.snapshot), " and a pre-screen" if self.prescreen else "",
+        )
+
+    def filter(self, domains: list[str]) -> list[FilterAction]:
+        labels = [tuple(reversed(normalize_domain(domain).split("."))) for domain in domains]
+        return self._dense(len(labels), self._match_positions(labels))
+
+    def filter_batch(self, batch: NormalizedBatch) -> list[FilterAction]:
+        return self._dense(len(batch), self._match_positions(batch.labels))
+
+    def filter_sparse(self, batch: NormalizedBatch) -> list[tuple[int, FilterAction]]:
+        action = self.filter_result_action
+        return [(i, action) for i in self._match_positions(batch.labels)]
+
+    def _match_positions(self, labels: Sequence[Sequence[str]]) -> list[int]:
+        """Returns the positions of the matching domains, given as labels ordered from the TLD down."""
+        if self.prescreen is not None:
+            positions = self.prescreen.candidates(labels)
+        else:
+            positions = range(len(labels))
+        match_key = self.snapshot.match_key
+        return [i for i in positions if match_key(labels_key(labels[i]))]
+
+    def _dense(self, size: int, positions: list[int]) -> list[FilterAction]:
+        res = [FilterAction.PASS] * size
+        for i in positions:
+            res[i] = self.filter_result_action
+        return res
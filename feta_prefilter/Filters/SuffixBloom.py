@@ -0,0 +1,160 @@
+import logging
+import math
+import os
+import struct
+from hashlib import blake2b
+from typing import Iterable, Sequence
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"FPBLOOM2"
+# magic, number of bits, number of hash functions, number of entries, fingerprint length, top-level entries length
+_HEADER = struct.Struct("<8sQIQIQ")
+_SEPARATOR = b"\n"
+
+
+def _hashes(key: str) -> tuple[int, int]:
+    h = int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), "little")
+    return h & 0xFFFFFFFF, h >> 32 | 1
+
+
+def probe_key(labels: Sequence[str]) -> str:
+    """The key of a domain given as labels ordered from the TLD down, its last two labels."""
+    return f"{labels[1]}.{labels[0]}" if len(labels) > 1 else labels[0]
+
+
+class SuffixBloom:
+    """Bloom filter pre-screen of a blocklist snapshot.
+
+    A domain can only match an entry that ends with the same two labels, so the
+    filter holds the last two labels of every entry, e.g. ``example.com`` for
+    ``www.example.com``, and a domain is probed once with its own last two
+    labels. Entries of a single label, e.g. a whole TLD, are kept in a set. A
+    lookup never misses a domain that matches an entry and passes a domain that
+    does not with a probability of about `fp_rate`, more if many entries share
+    their last two labels with the looked up domains.
+
+    A single probe is several times cheaper than a binary search in the
+    memory-mapped snapshot, but still more expensive than a lookup in an
+    in-memory `SuffixIndex`, so only the snapshots use a pre-screen.
+    """
+
+    def __init__(
+        self,
+        num_bits: int,
+        num_hashes: int,
+        bits: bytearray | None = None,
+        size: int = 0,
+        top_level: set[str] | None = None,
+    ):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+        self.size = size
+        self.top_level = top_level if top_level is not None else set()
+
+    @classmethod
+    def for_capacity(cls, capacity: int, fp_rate: float) -> "SuffixBloom":
+        assert 0 < fp_rate < 1, "fp_rate must be between 0 and 1"
+        capacity = max(capacity, 1)
+        num_bits = max(64, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+    @classmethod
+    def from_entries(cls, entries: Iterable[tuple[str, ...]], fp_rate: float) -> "SuffixBloom":
+        """Builds the filter from reversed label sequences as yielded by `BlockListSnapshot.entries`."""
+        keys = set()
+        top_level = set()
+        for labels in entries:
+            if len(labels) > 1:
+                keys.add(probe_key(labels))
+            else:
+                top_level.add(labels[0])
+
+        bloom = cls.for_capacity(len(keys), fp_rate)
+        bloom.top_level = top_level
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def add(self, key: str) -> None:
+        h1, h2 = _hashes(key)
+        bits = self.bits
+        for i in range(self.num_hashes):
+            bit = (h1 + i * h2) % self.num_bits
+            bits[bit >> 3] |= 1 << (bit & 7)
+        self.size += 1
+
+    def __contains__(self, key: str) -> bool:
+        h1, h2 = _hashes(key)
+        bits = self.bits
+        for i in range(self.num_hashes):
+            bit = (h1 + i * h2) % self.num_bits
+            if not bits[bit >> 3] & 1 << (bit & 7):
+                return False
+        return True
+
+    def may_match(self, labels: Sequence[str]) -> bool:
+        """Whether the domain, given as labels ordered from the TLD down, may match an entry."""
+        return labels[0] in self.top_level or probe_key(labels) in self
+
+    def candidates(self, labels: Iterable[Sequence[str]]) -> list[int]:
+        """Returns the positions of the domains that may match, `may_match` inlined into a single loop."""
+        bits = self.bits
+        num_bits = self.num_bits
+        probes = range(self.num_hashes)
+        top_level = self.top_level
+
+        res = []
+        append = res.append
+        for i, domain_labels in enumerate(labels):
+            if not domain_labels:
+                continue
+            if domain_labels[0] in top_level:
+                append(i)
+                continue
+            key = f"{domain_labels[1]}.{domain_labels[0]}" if len(domain_labels) > 1 else domain_labels[0]
+            h = int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), "little")
+            h1 = h & 0xFFFFFFFF
+            h2 = h >> 32 | 1
+            for j in probes:
+                bit = (h1 + j * h2) % num_bits
+                if not bits[bit >> 3] & 1 << (bit & 7):
+                    break
+            else:
+                append(i)
+        return res
+
+    def save(self, path: str, fingerprint: bytes = b"") -> None:
+        """Writes the filter atomically, `fingerprint` identifies the data it was built from."""
+        top_level = _SEPARATOR.join(label.encode() for label in sorted(self.top_level))
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(
+                _MAGIC, self.num_bits, self.num_hashes, self.size, len(fingerprint), len(top_level)
+            ))
+            f.write(fingerprint)
+            f.write(top_level)
+            f.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, fingerprint: bytes = b"") -> "SuffixBloom | None":
+        """Reads a saved filter, returns None if it is missing or was built from other data."""
+        try:
+            with open(path, "rb") as f:
+                magic, num_bits, num_hashes, size, fingerprint_len, top_level_len = _HEADER.unpack(
+                    f.read(_HEADER.size)
+                )
+                if magic != _MAGIC or f.read(fingerprint_len) != fingerprint:
+                    return None
+                top_level = f.read(top_level_len)
+                bits = bytearray(f.read())
+        except (OSError, struct.error):
+            return None
+
+        if len(bits) != (num_bits + 7) // 8:
+            return None
+        top_level = {label.decode() for label in top_level.split(_SEPARATOR) if label}
+        return cls(num_bits, num_hashes, bits, size, top_level)
@@ -2,6 +2,7 @@ from validators import domain as domain_validator
 
 from feta_prefilter.Filters.BaseFilter import FilterAction
 from feta_prefilter.Filters.BaseFilter import BaseFilter
+from feta_prefilter.normalize import NormalizedBatch
 
 
 class ValidDomainFilter(BaseFilter):
@@ -16,3 +17,12 @@ class ValidDomainFilter(BaseFilter):
             else:
                 res.append(self.filter_result_action)
         return res
+
+    def filter_batch(self, batch: NormalizedBatch) -> list[FilterAction]:
+        # the validity was already checked by the normalization
+        action = self.filter_result_action
+        return [FilterAction.PASS if valid else action for valid in batch.valid]
+
+    def filter_sparse(self, batch: NormalizedBatch) -> list[tuple[int, FilterAction]]:
+        action = self.filter_result_action
+        return [(i, action) for i, valid in enumerate(batch.valid) if not valid]
@@ -4,6 +4,7 @@ from .MISPFilter import MISPFilter
 from .ValidDomainFilter import ValidDomainFilter
 from .RandomDROPFilter import RandomDROPFilter
 from .CustomPostgresFilter import CustomPostgresFilter
+from .SnapshotBlockListFilter import SnapshotBlockListFilter
 
 filter_classes = {
     'FileBlockListFilter': FileBlockListFilter,
@@ -11,5 +12,6 @@ filter_classes = {
     'ValidDomainFilter': ValidDomainFilter,
     'RandomDROPFilter': RandomDROPFilter,
     'CustomPostgresFilter': CustomPostgresFilter,
-    'CloudflareTopFilter': CloudflareTopFilter
+    'CloudflareTopFilter': CloudflareTopFilter,
+    'SnapshotBlockListFilter': SnapshotBlockListFilter,
 }
@@ -1,6 +1,21 @@
+from feta_prefilter.batch import DomainBatch
+
+
 class BaseOutput:
     def __init__(self):
         pass
 
-    def output(self, domains: list[dict]) -> list[str]:
+    def output(self, domains: DomainBatch) -> list[str]:
         raise NotImplementedError()
+
+    def close(self) -> None:
+        """Called when the output is removed from the configuration, e.g. to close its connections."""
+        pass
+
+    def is_retryable(self, error: Exception) -> bool:
+        """Whether writing the batch again may succeed after `output` raised the error.
+
+        Errors caused by the data itself fail again on every attempt, so the
+        batch is given up on right away.
+        """
+        return not isinstance(error, (ValueError, TypeError))
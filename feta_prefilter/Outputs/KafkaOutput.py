@@ -0,0 +1,67 @@
+import json
+import logging
+
+from kafka import KafkaProducer
+
+from feta_prefilter.batch import DomainBatch
+from feta_prefilter.Outputs.BaseOutput import BaseOutput
+from feta_prefilter.utils import kafka_options
+
+logger = logging.getLogger(__name__)
+
+
+class KafkaOutput(BaseOutput):
+    """Produces the filtered domains to a Kafka topic.
+
+    Every domain is a JSON record keyed by the domain name, holding the
+    domain, its filter results and hits. The producer packs the records into
+    compressed batches of up to `batch_size` bytes, waiting up to `linger_ms`
+    for a batch to fill, and `output` returns once the whole batch of domains
+    has been acknowledged. If any record was not, `output` raises so that the
+    runner retries the batch.
+    """
+
+    def __init__(
+        self,
+        topic: str,
+        bootstrap_servers: str | None = None,
+        secrets_dir: str | None = None,
+        compression_type: str = "zstd",
+        linger_ms: int = 50,
+        batch_size: int = 1024 * 1024,
+        max_request_size: int = 8 * 1024 * 1024,
+        acks: int | str = 1,
+        producer_config: dict | None = None,
+    ):
+        self.topic = topic
+        self.producer = KafkaProducer(
+            client_id="loader-output",
+            compression_type=compression_type,
+            linger_ms=linger_ms,
+            batch_size=batch_size,
+            max_request_size=max_request_size,
+            acks=acks,
+            **kafka_options(bootstrap_servers, secrets_dir),
+            **(producer_config or {}),
+        )
+
+    def close(self) -> None:
+        self.producer.close()
+
+    def output(self, domains: DomainBatch) -> list[str]:
+        if not domains:
+            return []
+
+        topic = self.topic
+        send = self.producer.send
+        futures = [
+            send(topic, key=domain_info["domain"].encode(), value=json.dumps(domain_info).encode())
+            for domain_info in domains
+        ]
+        self.producer.flush()
+
+        failed = [(domain, future.exception) for domain, future in zip(domains.domains, futures) if future.failed()]
+        if failed:
+            domain, error = failed[0]
+            raise RuntimeError(f"Failed to send {len(failed)} of {len(futures)} domains to kafka, first {domain}") from error
+        return list(domains.domains)
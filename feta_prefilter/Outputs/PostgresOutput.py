@@ -1,17 +1,53 @@
+import io
 import json
 import logging
 
 import psycopg2
-from psycopg2.extras import Json
+from psycopg2.pool import ThreadedConnectionPool
 
+from feta_prefilter.batch import DomainBatch
 from feta_prefilter.Outputs.BaseOutput import BaseOutput
 
 logger = logging.getLogger(__name__)
 
+STAGING_TABLE = "domains_input_staging"
+# NULL marker of the COPY data, see `PostgresOutput.build_copy_data`
+COPY_NULL = "\\N"
+
+RETURN_ALL = "all"
+RETURN_INSERTED = "inserted"
+RETURN_NONE = "none"
+
+
+def _csv_quote(value: str) -> str:
+    return '"' + value.replace('"', '""') + '"'
+
+
 class PostgresOutput(BaseOutput):
+    """Upserts the domains into the ``domains_input`` table.
+
+    Every batch is streamed with ``COPY`` into a session-local staging table and
+    merged into ``domains_input`` with a single ``INSERT ... ON CONFLICT``.
+    Connections are kept in a pool and replaced when they break.
+
+    `returning` selects what `output` returns: the names of all upserted
+    domains (``all``), only of the newly inserted ones (``inserted``) or nothing
+    (``none``), which saves shipping the rows back from the database.
+    Database errors are raised from `output`, so the runner does not commit
+    the cursors of a batch that was not written.
+    """
+
     def __init__(
-        self, host: str, port: int, username: str, password: str, database: str
+        self,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        database: str,
+        returning: str = RETURN_ALL,
+        max_connections: int = 2,
     ):
+        assert returning in (RETURN_ALL, RETURN_INSERTED, RETURN_NONE), f"Unknown returning mode {returning}"
         self.db_connection_info = {
             "database": database,
             "host": host,
@@ -19,44 +55,95 @@ class PostgresOutput(BaseOutput):
             "user": username,
             "password": password,
         }
+        self.returning = returning
+        # connections are opened lazily on the first output
+        self._pool = ThreadedConnectionPool(0, max_connections, **self.db_connection_info)
+
+    def __del__(self):
+        if hasattr(self, "_pool"):
+            self.close()
 
-    def output(self, domains: list[dict]) -> list[str]:
-        ret = []
+    def close(self) -> None:
+        if not self._pool.closed:
+            self._pool.closeall()
+
+    def output(self, domains: DomainBatch) -> list[str]:
         if not domains:
+            return []
+
+        # a broken connection is dropped from the pool and the batch is retried once on a new one,
+        # any other error is raised so that the batch counts as failed
+        attempts = 2
+        for attempt in range(attempts):
+            conn = self._pool.getconn()
+            try:
+                with conn:
+                    with conn.cursor() as curr:
+                        ret = self.upsert(curr, domains)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self._pool.putconn(conn, close=True)
+                if attempt == attempts - 1:
+                    raise
+                logger.warning("Postgres connection lost, reconnecting")
+                continue
+            except Exception:
+                self._pool.putconn(conn)
+                raise
+
+            self._pool.putconn(conn)
             return ret
-        try:
-            command, param_list = self.build_query(domains)
-            with psycopg2.connect(**self.db_connection_info) as conn:
-                with conn.cursor() as curr:
-                    curr.execute(command, param_list)
-                    ret = [row[1] for row in curr.fetchall()]
-        except Exception:
-            logger.exception("Exception raised while sending data to postgres")
-            logger.error(f"Postgres command: {command}")
-            logger.error(f"Postgres command params: {param_list}")
-        return ret
-
-    def build_query(self, domains: list[dict]) -> tuple[str, list]:
-        str_list = []
-        param_list = []
-        for domain_info in domains:
-            domain = domain_info["domain"]
-            domain_data = domain_info["f_results"]
-            if domain_data:
-                str_list.append(r"(%s, NOW(), %s)")
-                param_list.extend([domain, Json(domain_data)])
-            else:
-                str_list.append(r"(%s, NOW(), NULL)")
-                param_list.extend([domain])
-
-        domains_to_insert = ",\n".join(str_list)
-        command = f"""
+
+    def is_retryable(self, error: Exception) -> bool:
+        # rows violating a constraint or a type, or a broken query, fail the same way again
+        if isinstance(error, (psycopg2.DataError, psycopg2.IntegrityError, psycopg2.ProgrammingError)):
+            return False
+        return super().is_retryable(error)
+
+    def upsert(self, curr, domains: DomainBatch) -> list[str]:
+        curr.execute(
+            f"""
+            CREATE TEMP TABLE IF NOT EXISTS "{STAGING_TABLE}"
+            ON COMMIT DELETE ROWS
+            AS SELECT "domain", "filter_output" FROM "domains_input" WITH NO DATA;
+            """
+        )
+        curr.copy_expert(
+            f'COPY "{STAGING_TABLE}" ("domain", "filter_output") FROM STDIN WITH (FORMAT csv, NULL \'{COPY_NULL}\')',
+            self.build_copy_data(domains),
+        )
+        curr.execute(self.build_merge_query())
+
+        if self.returning == RETURN_NONE:
+            return []
+        elif self.returning == RETURN_INSERTED:
+            return [row[0] for row in curr.fetchall() if row[1]]
+        else:
+            return [row[0] for row in curr.fetchall()]
+
+    def build_copy_data(self, domains: DomainBatch) -> io.StringIO:
+        # every value is quoted, so only the unquoted marker is loaded as NULL, never an empty string
+        filter_output = [COPY_NULL] * len(domains)
+        # only the stored domains carry filter results
+        for i in domains.stored_positions():
+            filter_output[i] = _csv_quote(json.dumps(domains.f_results(i)))
+        data = io.StringIO("".join(
+            f"{_csv_quote(domain)},{output}\n" for domain, output in zip(domains.domains, filter_output)
+        ))
+        return data
+
+    def build_merge_query(self) -> str:
+        if self.returning == RETURN_NONE:
+            returning = ""
+        else:
+            # xmax is 0 for freshly inserted rows and set for the updated ones
+            returning = 'RETURNING "domain", (xmax = 0) AS inserted'
+
+        return f"""
         INSERT INTO "domains_input" ("domain", "last_seen", "filter_output")
-        VALUES
-            {domains_to_insert}
+        SELECT DISTINCT ON ("domain") "domain", NOW(), "filter_output"
+        FROM "{STAGING_TABLE}"
         ON CONFLICT ("domain")
         DO UPDATE SET
             last_seen = NOW()
-        RETURNING *;
+        {returning};
         """
-        return command, param_list
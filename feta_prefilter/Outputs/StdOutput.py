@@ -1,25 +1,24 @@
 import logging
-from datetime import datetime
 
+from feta_prefilter.batch import DomainBatch
+from feta_prefilter.dedup import DedupCache
 from feta_prefilter.Outputs.BaseOutput import BaseOutput
 
 logger = logging.getLogger(__name__)
 
 class StdOutput(BaseOutput):
-    def __init__(self):
-        # cache for already outputted domains with timestamps for clearing
-        # TODO this cache will grow infinitely, fix?
-        self._cache = {}
+    def __init__(self, cache_ttl_s: float = 86400.0, cache_max_entries: int = 1_000_000):
+        # cache of already outputted domains, a domain is printed again once it expires
+        self._cache = DedupCache(ttl_s=cache_ttl_s, max_entries=cache_max_entries)
 
-    def output(self, domains: list[dict]) -> list[str]:
+    def output(self, domains: DomainBatch) -> list[str]:
         ret = []
         logger.info("START stdoutput")
-        for domain_info in domains:
-            domain = domain_info["domain"]
-            domain_data = domain_info["f_results"]
-            if domain not in self._cache:
-                self._cache[domain] = datetime.utcnow()
+        new_domains = self._cache.add_many(domains.domains)
+        for i, new in enumerate(new_domains):
+            if new:
+                domain = domains.domains[i]
                 ret.append(domain)
-                print(domain, domain_data)
+                print(domain, domains.f_results(i))
         logger.info("FINISH stdoutput")
         return ret
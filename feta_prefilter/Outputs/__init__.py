@@ -1,7 +1,9 @@
 from .StdOutput import StdOutput
 from .PostgresOutput import PostgresOutput
+from .KafkaOutput import KafkaOutput
 
 output_classes = {
     'StdOutput': StdOutput,
     'PostgresOutput': PostgresOutput,
+    'KafkaOutput': KafkaOutput,
 }
@@ -0,0 +1,235 @@
+import logging
+import time
+from datetime import datetime, timedelta
+
+from elasticsearch import Elasticsearch
+from feta_prefilter.Sources.BaseSource import BaseSource
+from feta_prefilter.utils import get_field
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 10000  # 10k is max size as per ELK spec
+
+
+class BaseELKSource(BaseSource):
+    """Collects queried domain names from DNS logs in Elasticsearch.
+
+    Subclasses define the index, the fields and the query clauses. Every
+    collect fetches one page of hits sorted by the timestamp, continuing after
+    the last hit of the previous page, and only the domain field of the hits
+    is transferred. After a full page the source reports itself ready again
+    right away, so it keeps draining pages until it has caught up.
+
+    With `streaming`, the pages are read from a point-in-time opened when the
+    source starts catching up, sorted by the timestamp and the ``_shard_doc``
+    tiebreaker, so hits sharing a timestamp are neither skipped nor repeated
+    within the point-in-time. Once caught up, the point-in-time is closed and
+    the next one starts at the last seen timestamp.
+
+    With `aggregate`, the log records are not transferred at all. A composite
+    ``terms`` aggregation on `aggregation_field` (the domain field by default,
+    it has to be a keyword field) pages through the distinct domains of the
+    time window since the previous collect together with their record counts,
+    which are passed to the outputs as ``hits``.
+    """
+
+    index: str
+    timestamp_field: str
+    domain_field: str
+    # how far back the first collect looks
+    lookback: timedelta
+
+    def __init__(
+        self,
+        elk_url: str,
+        poll_interval_s: float = 1.0,
+        streaming: bool = False,
+        page_size: int = PAGE_SIZE,
+        pit_keep_alive: str = "1m",
+        aggregate: bool = False,
+        aggregation_field: str | None = None,
+    ):
+        assert not (streaming and aggregate), "streaming and aggregate modes are exclusive"
+        self.es = Elasticsearch(elk_url)
+        self._latest_sort = [0]
+        self.poll_interval_s = poll_interval_s
+        self.streaming = streaming
+        self.page_size = page_size
+        self.pit_keep_alive = pit_keep_alive
+        self._behind = False
+        self._pit_id = None
+        self._pit_sort = None
+        self.aggregate = aggregate
+        self.aggregation_field = aggregation_field or self.domain_field
+        # time window being aggregated and the key of the last bucket read from it
+        self._window = None
+        self._window_end = None
+        self._after_key = None
+
+    def query_clauses(self) -> list[dict]:
+        raise NotImplementedError()
+
+    def build_query(self, time_range: dict) -> dict:
+        return {
+            "bool": {
+                "must": self.query_clauses(),
+                "filter": [
+                    {"range": {self.timestamp_field: time_range}},
+                ],
+            }
+        }
+
+    def collect(self) -> list[str]:
+        if self.aggregate:
+            yield from self._aggregate()
+            return
+
+        logger.debug("START %s", datetime.utcnow())
+        hits = self._search_streaming() if self.streaming else self._search()
+        logger.debug("FINISH %s", datetime.utcnow())
+        # a full page means we are behind, the next page is ready right away
+        self._behind = len(hits) == self.page_size
+
+        domains = []
+        missing = 0
+        for hit in hits:
+            try:
+                domains.append(get_field(hit["_source"], self.domain_field))
+            except (KeyError, TypeError):
+                missing += 1
+                logger.debug("Document %s has no field %s", hit.get("_id"), self.domain_field)
+        if missing:
+            logger.warning("Skipped %d documents without the field %s", missing, self.domain_field)
+
+        # the cursor moves past the page only once all of its domains were read
+        if hits:
+            self._advance(hits[-1]["sort"])
+            logger.debug("Last record from elk from this call %s", hits[-1]["sort"][0])
+        yield from domains
+
+    def collect_counts(self) -> dict[str, int]:
+        if self.aggregate:
+            return self._aggregate()
+        return super().collect_counts()
+
+    def get_cursor(self) -> dict | None:
+        return {
+            "latest_sort": self._latest_sort,
+            "window_end": self._window_end.isoformat() if self._window_end is not None else None,
+        }
+
+    def set_cursor(self, cursor: dict) -> None:
+        self._latest_sort = cursor["latest_sort"][:1] if self.streaming else cursor["latest_sort"]
+        if cursor.get("window_end"):
+            self._window_end = datetime.fromisoformat(cursor["window_end"])
+
+    def next_ready(self) -> float | None:
+        return time.monotonic() if self._behind else None
+
+    def _search(self) -> list[dict]:
+        since = datetime.utcnow() - self.lookback
+        results = self.es.search(
+            index=self.index,
+            query=self.build_query({"gt": since.isoformat()}),
+            sort=[
+                {self.timestamp_field: "asc"},
+            ],
+            search_after=self._latest_sort,
+            size=self.page_size,
+            source=[self.domain_field],
+        )
+        return results.body["hits"]["hits"]
+
+    def _advance(self, sort: list) -> None:
+        """Moves the cursor past the hit with the sort values."""
+        if not self.streaming:
+            self._latest_sort = sort
+            return
+        if self._pit_id is not None:
+            self._pit_sort = sort
+        self._latest_sort = sort[:1]
+
+    def _aggregate(self) -> dict[str, int]:
+        if self._window is None:
+            now = datetime.utcnow()
+            start = self._window_end or now - self.lookback
+            self._window = (start, now)
+        start, end = self._window
+
+        composite = {
+            "size": self.page_size,
+            "sources": [{"domain": {"terms": {"field": self.aggregation_field}}}],
+        }
+        if self._after_key is not None:
+            composite["after"] = self._after_key
+
+        logger.debug("START %s", datetime.utcnow())
+        results = self.es.search(
+            index=self.index,
+            query=self.build_query({"gte": start.isoformat(), "lt": end.isoformat()}),
+            aggs={"domains": {"composite": composite}},
+            size=0,
+        )
+        logger.debug("FINISH %s", datetime.utcnow())
+        aggregation = results.body["aggregations"]["domains"]
+        buckets = aggregation["buckets"]
+
+        self._behind = len(buckets) == self.page_size
+        if self._behind:
+            self._after_key = aggregation.get("after_key", buckets[-1]["key"])
+        else:
+            # the window is done, the next one starts where it ended
+            self._window = None
+            self._after_key = None
+            self._window_end = end
+        return {bucket["key"]["domain"]: bucket["doc_count"] for bucket in buckets}
+
+    def _search_streaming(self) -> list[dict]:
+        if self._pit_id is None:
+            self._pit_id = self.es.open_point_in_time(index=self.index, keep_alive=self.pit_keep_alive)["id"]
+            self._pit_sort = None
+
+        if self._latest_sort[0]:
+            # hits at the last seen timestamp may be read again when a new point-in-time starts
+            time_range = {"gte": self._latest_sort[0], "format": "epoch_millis"}
+        else:
+            time_range = {"gt": (datetime.utcnow() - self.lookback).isoformat()}
+
+        try:
+            results = self.es.search(
+                pit={"id": self._pit_id, "keep_alive": self.pit_keep_alive},
+                query=self.build_query(time_range),
+                sort=[
+                    {self.timestamp_field: "asc"},
+                    {"_shard_doc": "asc"},
+                ],
+                search_after=self._pit_sort,
+                size=self.page_size,
+                source=[self.domain_field],
+            )
+        except Exception:
+            # the point-in-time may have expired, start a new one on the next call
+            self._close_pit()
+            raise
+
+        self._pit_id = results.body.get("pit_id", self._pit_id)
+        hits = results.body["hits"]["hits"]
+        if len(hits) < self.page_size:
+            # caught up, new documents only show up in a new point-in-time
+            self._close_pit()
+        return hits
+
+    def close(self) -> None:
+        # an open point-in-time holds the search contexts of its shards until it expires
+        self._close_pit()
+        self.es.close()
+
+    def _close_pit(self) -> None:
+        if self._pit_id is None:
+            return
+        try:
+            self.es.close_point_in_time(id=self._pit_id)
+        except Exception:
+            logger.debug("Cannot close point-in-time", exc_info=True)
+        self._pit_id = None
+        self._pit_sort = None
@@ -1,6 +1,38 @@
+from collections import Counter
+
+
 class BaseSource:
+    # seconds between two polls of a source that keeps returning domains
+    poll_interval_s = 0.0
+    # upper bound of the exponential backoff applied while polls return nothing
+    max_backoff_s = 10.0
+
     def __init__(self):
         pass
 
     def collect(self) -> list[str]:
         raise NotImplementedError()
+
+    def next_ready(self) -> float | None:
+        """Returns the `time.monotonic()` time at which the source has new domains, None if unknown."""
+        return None
+
+    def collect_counts(self) -> dict[str, int]:
+        """Returns the collected domain names with the number of their occurrences."""
+        return Counter(self.collect())
+
+    def get_cursor(self) -> dict | None:
+        """Returns the JSON-serializable position of the source for checkpointing, None if it has none."""
+        return None
+
+    def set_cursor(self, cursor: dict) -> None:
+        """Resumes the source from a cursor returned by `get_cursor`."""
+        pass
+
+    def commit(self, cursor: dict) -> None:
+        """Called from the output stage once the domains collected up to the cursor were output."""
+        pass
+
+    def close(self) -> None:
+        """Called once the source is no longer polled, releases its threads and files."""
+        pass
@@ -1,50 +1,23 @@
-import logging
-from datetime import datetime, timedelta
+from datetime import timedelta
 
-from elasticsearch import Elasticsearch
-from feta_prefilter.Sources.BaseSource import BaseSource
+from feta_prefilter.Sources.BaseELKSource import BaseELKSource
 
-logger = logging.getLogger(__name__)
 
+class CesnetELKSource(BaseELKSource):
+    index = "logstash-dns-*"
+    timestamp_field = "@timestamp"
+    domain_field = "DNS_Q_NAME"
+    lookback = timedelta(minutes=10)
 
-class CesnetELKSource(BaseSource):
-    def __init__(self, elk_url: str):
-        self.es = Elasticsearch(elk_url)
-        self._latest_sort = [0]
-
-    def collect(self) -> list[str]:
-        last_10_minutes = datetime.utcnow() - timedelta(minutes=10)
-        logger.debug("START %s", datetime.utcnow())
-        results = self.es.search(
-            index="logstash-dns-*",
-            query={
+    def query_clauses(self) -> list[dict]:
+        return [
+            {"match": {"type": "dnsdata"}},
+            {
                 "bool": {
-                    "must": [
-                        {"match": {"type": "dnsdata"}},
-                        {
-                            "bool": {
-                                "should": [
-                                    {"match": {"FME_DNS_RR_TYPE": 1}},   # A
-                                    {"match": {"FME_DNS_RR_TYPE": 28}},  # AAAA
-                                ]
-                            }
-                        },
-                    ],
-                    "filter": [
-                        {"range": {"@timestamp": {"gt": last_10_minutes.isoformat()}}},
-                    ],
+                    "should": [
+                        {"match": {"FME_DNS_RR_TYPE": 1}},   # A
+                        {"match": {"FME_DNS_RR_TYPE": 28}},  # AAAA
+                    ]
                 }
             },
-            sort=[
-                {"@timestamp": "asc"},
-            ],
-            search_after=self._latest_sort,
-            size=10000, # 10k is max size as per ELK spec
-        )
-        logger.debug("FINISH %s", datetime.utcnow())
-        timestamp = None
-        for hit in results.body["hits"]["hits"]:
-            self._latest_sort = hit["sort"]
-            timestamp = hit["_source"]["@timestamp"]
-            yield hit["_source"]["DNS_Q_NAME"]
-        logger.debug("Last record from elk from this call %s", timestamp)
+        ]
@@ -1,51 +1,24 @@
-import logging
-from datetime import datetime, timedelta
+from datetime import timedelta
 
-from elasticsearch import Elasticsearch
-from feta_prefilter.Sources.BaseSource import BaseSource
+from feta_prefilter.Sources.BaseELKSource import BaseELKSource
 
-logger = logging.getLogger(__name__)
 
+class ELKSource(BaseELKSource):
+    index = "logstash-*"
+    timestamp_field = "timestamp"
+    domain_field = "dns.rrname"
+    lookback = timedelta(days=1)
 
-class ELKSource(BaseSource):
-    def __init__(self, elk_url: str):
-        self.es = Elasticsearch(elk_url)
-        self._latest_sort = [0]
-
-    def collect(self) -> list[str]:
-        last_1_day = datetime.utcnow() - timedelta(days=1)
-        logger.debug("START %s", datetime.utcnow())
-        results = self.es.search(
-            index="logstash-*",
-            query={
+    def query_clauses(self) -> list[dict]:
+        return [
+            {"match": {"event_type": "dns"}},
+            {"match": {"dns.type": "query"}},
+            {
                 "bool": {
-                    "must": [
-                        {"match": {"event_type": "dns"}},
-                        {"match": {"dns.type": "query"}},
-                        {
-                            "bool": {
-                                "should": [
-                                    {"match": {"dns.rrtype": "A"}},
-                                    {"match": {"dns.rrtype": "AAAA"}},
-                                ]
-                            }
-                        },
-                    ],
-                    "filter": [
-                        {"range": {"timestamp": {"gt": last_1_day.isoformat()}}},
-                    ],
+                    "should": [
+                        {"match": {"dns.rrtype": "A"}},
+                        {"match": {"dns.rrtype": "AAAA"}},
+                    ]
                 }
             },
-            sort=[
-                {"timestamp": "asc"},
-            ],
-            search_after=self._latest_sort,
-            size=10000, # 10k is max size as per ELK spec
-        )
-        logger.debug("FINISH %s", datetime.utcnow())
-        timestamp = None
-        for hit in results.body["hits"]["hits"]:
-            self._latest_sort = hit["sort"]
-            timestamp = hit["_source"]["@timestamp"]
-            yield hit["_source"]["dns"]["rrname"]
-        logger.debug("Last record from elk from this call %s", timestamp)
+        ]
@@ -0,0 +1,191 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from kafka import KafkaConsumer
+from kafka.errors import CommitFailedError
+from kafka.structs import OffsetAndMetadata, TopicPartition
+
+from feta_prefilter.Sources.BaseSource import BaseSource
+from feta_prefilter.utils import kafka_options
+
+logger = logging.getLogger(__name__)
+
+FORMAT_TEXT = "text"
+FORMAT_JSON = "json"
+
+
+def _topic_partition(key: str) -> TopicPartition:
+    topic, partition = key.rsplit(":", 1)
+    return TopicPartition(topic, int(partition))
+
+
+class KafkaSource(BaseSource):
+    """Consumes domain names from Kafka topics.
+
+    A record holds one or more domain names, one per line (``text``) or as a
+    JSON string or list of strings (``json``). Offsets are not committed
+    automatically, the offsets of a batch are committed only after the outputs
+    processed it, so a crashed loader consumes the unprocessed records again.
+    A batch that fails to be parsed is polled again, so the offsets of the
+    following batches never skip it. A restored cursor is applied by seeking
+    the partitions once they are assigned to a consumer.
+
+    With `consumers` greater than one, several consumers of the same group poll
+    their share of the partitions in parallel.
+    """
+
+    # the consumers wait for records themselves, see `poll_timeout_ms`
+    max_backoff_s = 0.0
+
+    def __init__(
+        self,
+        topics: list[str],
+        group_id: str = "loader-source",
+        bootstrap_servers: str | None = None,
+        secrets_dir: str | None = None,
+        record_format: str = FORMAT_TEXT,
+        max_poll_records: int = 10000,
+        poll_timeout_ms: int = 1000,
+        consumers: int = 1,
+        consumer_config: dict | None = None,
+    ):
+        assert record_format in (FORMAT_TEXT, FORMAT_JSON), f"Unknown record format {record_format}"
+        assert consumers > 0, "consumers must be positive"
+        self.record_format = record_format
+        self.max_poll_records = max_poll_records
+        self.poll_timeout_ms = poll_timeout_ms
+
+        options = kafka_options(bootstrap_servers, secrets_dir)
+        self.consumers = [
+            KafkaConsumer(
+                *topics,
+                client_id=f"loader-source-{i}",
+                group_id=group_id,
+                enable_auto_commit=False,
+                auto_offset_reset="earliest",
+                max_poll_records=max_poll_records,
+                **options,
+                **(consumer_config or {}),
+            )
+            for i in range(consumers)
+        ]
+        self._executor = ThreadPoolExecutor(max_workers=consumers) if consumers > 1 else None
+
+        # next offsets of the consumed records, "topic:partition" -> offset
+        self._offsets: dict[str, int] = {}
+        # offsets of output batches, committed by the polling thread as the consumers are not thread-safe
+        self._commit_lock = threading.Lock()
+        self._pending_commit: dict[str, int] | None = None
+        # offsets of a restored cursor, applied when their partitions are assigned
+        self._seek_offsets: dict[TopicPartition, int] = {}
+        self._behind = False
+
+    def collect(self) -> list[str]:
+        self._commit_pending()
+        if self._executor is not None:
+            polled = list(self._executor.map(self._poll, self.consumers))
+        else:
+            polled = [self._poll(self.consumers[0])]
+
+        self._behind = False
+        offsets = dict(self._offsets)
+        try:
+            for records in polled:
+                for tp, messages in records.items():
+                    if len(messages) >= self.max_poll_records:
+                        self._behind = True
+                    for msg in messages:
+                        yield from self._parse(msg.value)
+                    if messages:
+                        self._offsets[f"{tp.topic}:{tp.partition}"] = messages[-1].offset + 1
+        except Exception:
+            # rewind to the start of the failed batch, so its records are polled again
+            self._offsets = offsets
+            for consumer, records in zip(self.consumers, polled):
+                for tp, messages in records.items():
+                    if messages:
+                        consumer.seek(tp, messages[0].offset)
+            raise
+
+    def next_ready(self) -> float | None:
+        return time.monotonic() if self._behind else None
+
+    def get_cursor(self) -> dict | None:
+        return dict(self._offsets) if self._offsets else None
+
+    def set_cursor(self, cursor: dict) -> None:
+        self._offsets = dict(cursor)
+        with self._commit_lock:
+            self._seek_offsets = {_topic_partition(key): offset for key, offset in cursor.items()}
+
+    def commit(self, cursor: dict) -> None:
+        with self._commit_lock:
+            self._pending_commit = cursor
+
+    def close(self) -> None:
+        # the consumers leave the group right away, so their partitions are reassigned without waiting for
+        # the session to time out
+        self._commit_pending()
+        for consumer in self.consumers:
+            try:
+                consumer.close(autocommit=False)
+            except Exception:
+                logger.warning("Cannot close a Kafka consumer", exc_info=True)
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _poll(self, consumer: KafkaConsumer) -> dict:
+        records = consumer.poll(timeout_ms=self.poll_timeout_ms, max_records=self.max_poll_records)
+        if not self._seek_offsets:
+            return records
+
+        # the partitions are assigned by the first poll, the records it fetched before the seek are skipped
+        assigned = consumer.assignment()
+        with self._commit_lock:
+            seeks = {tp: self._seek_offsets.pop(tp) for tp in list(self._seek_offsets) if tp in assigned}
+        for tp, offset in seeks.items():
+            consumer.seek(tp, offset)
+        return {tp: messages for tp, messages in records.items() if tp not in seeks}
+
+    def _parse(self, value: bytes):
+        if value is None:
+            return
+        if self.record_format == FORMAT_TEXT:
+            for line in value.decode(errors="replace").splitlines():
+                if line.strip():
+                    yield line.strip()
+            return
+
+        try:
+            domains = json.loads(value)
+        except json.JSONDecodeError:
+            logger.debug("Cannot decode record %s", value)
+            return
+        if isinstance(domains, str):
+            yield domains
+        elif isinstance(domains, list):
+            yield from (domain for domain in domains if isinstance(domain, str))
+
+    def _commit_pending(self) -> None:
+        with self._commit_lock:
+            cursor, self._pending_commit = self._pending_commit, None
+        if not cursor:
+            return
+
+        offsets = {}
+        for key, offset in cursor.items():
+            offsets[_topic_partition(key)] = OffsetAndMetadata(offset, "", -1)
+
+        for consumer in self.consumers:
+            # every consumer commits the partitions it is assigned, the others were rebalanced away
+            assigned = consumer.assignment()
+            own_offsets = {tp: offset for tp, offset in offsets.items() if tp in assigned}
+            if not own_offsets:
+                continue
+            try:
+                consumer.commit(own_offsets)
+            except CommitFailedError:
+                logger.warning("Cannot commit offsets, the partitions were rebalanced", exc_info=True)
@@ -15,11 +15,21 @@ class MISPSource(BaseSource):
         misp_url: str,
         misp_key: str,
         misp_feed_eventids: list[int],
+        poll_interval_s: float = 60.0,
     ):
         self.misp = PyMISP(misp_url, misp_key, ssl=False)
         self.misp_feed_eventids = misp_feed_eventids
+        self.poll_interval_s = poll_interval_s
+        # new attributes are rare, back off up to the poll interval
+        self.max_backoff_s = poll_interval_s
         self.last_timestamp = datetime.now() - timedelta(days=1)
 
+    def get_cursor(self) -> dict | None:
+        return {"last_timestamp": self.last_timestamp.isoformat()}
+
+    def set_cursor(self, cursor: dict) -> None:
+        self.last_timestamp = datetime.fromisoformat(cursor["last_timestamp"])
+
     def collect(self) -> list[str]:
         attributes = self.misp.search(
             controller="attributes", to_ids=True, eventid=self.misp_feed_eventids, timestamp=self.last_timestamp
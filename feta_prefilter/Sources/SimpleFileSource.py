@@ -1,10 +1,40 @@
+import logging
+
 from feta_prefilter.Sources.BaseSource import BaseSource
+from feta_prefilter.filewatch import read_appended_lines
+
+logger = logging.getLogger(__name__)
 
 
 class SimpleFileSource(BaseSource):
+    """Collects the domains listed in a file, one per line.
+
+    The first poll returns the whole file, later polls only the lines appended
+    since. A file that was replaced or rewritten is read from the start again.
+    The position in the file is the cursor of the source.
+    """
+
+    # a file is cheap to check, appended lines are picked up within a second
+    max_backoff_s = 1.0
+
     def __init__(self, filename=''):
-        with open(filename) as f:
-            self.domains = [l.strip() for l in f.readlines()]
+        self.filename = filename
+        self._position: dict | None = None
 
     def collect(self) -> list[str]:
-        return self.domains
+        try:
+            appended = read_appended_lines(self.filename, self._position)
+            if appended is None:
+                logger.info(f"File {self.filename} was rewritten, reading it from the start")
+                appended = read_appended_lines(self.filename, None)
+        except FileNotFoundError:
+            # the file is being replaced
+            return []
+        domains, self._position = appended
+        return domains
+
+    def get_cursor(self) -> dict | None:
+        return self._position
+
+    def set_cursor(self, cursor: dict) -> None:
+        self._position = cursor
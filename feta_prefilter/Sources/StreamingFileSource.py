@@ -1,57 +1,256 @@
+import gzip
+import json
+import logging
+import queue
 import random
+import threading
 import time
+from typing import BinaryIO
 
 from feta_prefilter.Sources.BaseSource import BaseSource
+from feta_prefilter.utils import get_field
+
+logger = logging.getLogger(__name__)
 
 MS = 1_000_000
+NS_PER_S = 1_000_000_000
+
+COMPRESSION_AUTO = "auto"
+COMPRESSION_NONE = "none"
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZSTD = "zstd"
+
+FORMAT_TEXT = "text"
+FORMAT_JSONL = "jsonl"
+
+# how long a poll waits for the reader thread when no domains are buffered
+READ_WAIT_S = 0.5
+
+
+def open_compressed(path: str, compression: str = COMPRESSION_AUTO) -> BinaryIO:
+    """Opens the file for binary reading, decompressing it on the fly.
+
+    With ``auto``, the compression is chosen by the extension: ``.gz`` is gzip,
+    ``.zst`` and ``.zstd`` are zstd, anything else is read as it is. zstd
+    needs the optional ``zstandard`` package.
+    """
+    if compression == COMPRESSION_AUTO:
+        if path.endswith(".gz"):
+            compression = COMPRESSION_GZIP
+        elif path.endswith((".zst", ".zstd")):
+            compression = COMPRESSION_ZSTD
+        else:
+            compression = COMPRESSION_NONE
+
+    if compression == COMPRESSION_GZIP:
+        return gzip.open(path, "rb")
+    elif compression == COMPRESSION_ZSTD:
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("Reading zstd files requires the zstandard package") from e
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True)
+    elif compression == COMPRESSION_NONE:
+        return open(path, "rb")
+    raise ValueError(f"Unknown compression {compression}")
 
 
 class StreamingFileSource(BaseSource):
+    """Replays domain names from a file, e.g. a captured DNS query log.
+
+    A background thread reads the file in chunks of `chunk_size` bytes ahead of
+    the polls, up to `read_ahead` chunks, and splits them into domain names:
+    one per line (``text``) or the `field` (a dotted path) of every JSON object
+    of a JSON Lines file (``jsonl``), where the field may also hold a list of
+    names. Malformed lines are skipped. gzip and zstd files are decompressed on
+    the fly, see `open_compressed`. The file is opened when the source is
+    created, so a missing file fails the configuration. With `repeat`, the
+    file is replayed again from the start whenever it ends, unless a whole
+    pass over it found no domains.
+
+    With `rate` set, the source emits `rate` domains per second, in batches
+    every `batch_interval_ms`. The number of emitted domains follows the
+    elapsed time, so the rate stays exact in the long run regardless of the
+    poll timing, and a reader that fell behind is caught up in batches of up to
+    `max_batch_size`. ``rate: 0`` replays the file as fast as the pipeline
+    takes it. Without `rate`, `entries_per_produce` domains are emitted every
+    `delay_ms` with a random `jitter_ms`.
+    """
 
     def __init__(self, filename: str = '', delay_ms: int = 1000, jitter_ms: int = 100,
-                 entries_per_produce: int = 1, entries_per_produce_jitter: int = 0, repeat: bool = False):
-        self.file = open(filename, 'r')
+                 entries_per_produce: int = 1, entries_per_produce_jitter: int = 0, repeat: bool = False,
+                 rate: float | None = None, batch_interval_ms: int = 100, max_batch_size: int = 100_000,
+                 format: str = FORMAT_TEXT, field: str | None = None, compression: str = COMPRESSION_AUTO,
+                 chunk_size: int = 1024 * 1024, read_ahead: int = 4):
+        assert format in (FORMAT_TEXT, FORMAT_JSONL), f"Unknown format {format}"
+        assert format != FORMAT_JSONL or field, "field is required for jsonl files"
+        assert rate is None or rate >= 0, "rate must be a non-negative number of domains per second"
+        self.filename = filename
+        self.compression = compression
+        self.format = format
+        self.field = field
+        self.chunk_size = chunk_size
         self.delay = delay_ms - jitter_ms // 2
         self.jitter = jitter_ms
-        self.repeat = repeat and self.file.seekable()
+        self.repeat = repeat
         self.entries_per_produce = entries_per_produce
         self.entries_per_produce_jitter = entries_per_produce_jitter
+        self.rate = rate
+        self.max_batch_size = max_batch_size
+        # number of domains emitted per batch at the target rate
+        self._quantum = max(1, round(rate * batch_interval_ms / 1000)) if rate else 1
+        # the first pass reads the file opened here, owned by the reader thread once it starts
+        self._file: BinaryIO | None = open_compressed(filename, compression)
+
+        # blocks of parsed domains read ahead, None marks the end of the file
+        self._blocks: queue.Queue[list[str] | None] = queue.Queue(max(1, read_ahead))
+        self._buffer: list[str] = []
+        self._buffer_pos = 0
+        self._eof = False
+        self._ended = False
+        self._closed = threading.Event()
+        self._reader: threading.Thread | None = None
 
+        self._rate_start: float | None = None
+        self._emitted = 0
         self._rnd = random.Random()
         self._next = 0
         self._make_next()
-        self._ended = False
 
-    def __del__(self):
-        if hasattr(self, 'file') and self.file is not None and not self.file.closed:
-            self.file.close()
+    def close(self) -> None:
+        self._closed.set()
+        if self._reader is None and self._file is not None:
+            self._file.close()
+            self._file = None
 
     def collect(self) -> list[str]:
-        if not self._ended and time.monotonic_ns() > self._next:
-            to_produce = []
+        if self._ended:
+            return []
+        if self._reader is None:
+            self._reader = threading.Thread(target=self._read_loop, name="streaming-file-reader", daemon=True)
+            self._reader.start()
 
+        if self.rate is None:
+            if time.monotonic_ns() <= self._next:
+                return []
             if self.entries_per_produce_jitter > 0:
                 num_entries = max(1, self.entries_per_produce - (self.entries_per_produce_jitter // 2) +
                                   self._rnd.randint(0, self.entries_per_produce_jitter))
             else:
                 num_entries = self.entries_per_produce
+            self._make_next()
+            return self._take(num_entries)
 
-            for _ in range(num_entries):
-                line = self.file.readline()
-                if not line:
-                    if self.repeat:
-                        self.file.seek(0)
-                        line = self.file.readline()
-                    else:
-                        self._ended = True
-                        self.file.close()
-                        return []
-                to_produce.append(line.strip())
+        if not self.rate:
+            return self._take(self.max_batch_size)
 
-            self._make_next()
-            return to_produce
+        now = time.monotonic()
+        if self._rate_start is None:
+            self._rate_start = now
+        due = int(self.rate * (now - self._rate_start)) - self._emitted
+        if due < self._quantum:
+            return []
+        domains = self._take(min(due, self.max_batch_size))
+        self._emitted += len(domains)
+        return domains
+
+    def next_ready(self) -> float | None:
+        if self._ended:
+            return None
+        if self.rate is None:
+            return self._next / NS_PER_S
+        if not self.rate or self._rate_start is None:
+            return None
+        return self._rate_start + (self._emitted + self._quantum) / self.rate
+
+    def _take(self, count: int) -> list[str]:
+        res = []
+        while len(res) < count:
+            if self._buffer_pos == len(self._buffer):
+                if self._eof:
+                    self._ended = True
+                    break
+                try:
+                    # wait for the reader only while nothing was taken yet
+                    block = self._blocks.get(timeout=READ_WAIT_S) if not res else self._blocks.get_nowait()
+                except queue.Empty:
+                    break
+                if block is None:
+                    self._eof = True
+                    continue
+                self._buffer = block
+                self._buffer_pos = 0
 
-        return []
+            end = min(len(self._buffer), self._buffer_pos + count - len(res))
+            res.extend(self._buffer[self._buffer_pos:end])
+            self._buffer_pos = end
+        return res
+
+    def _read_loop(self) -> None:
+        try:
+            while not self._closed.is_set():
+                f = self._file if self._file is not None else open_compressed(self.filename, self.compression)
+                self._file = None
+                remainder = b""
+                found = 0
+                with f:
+                    while not self._closed.is_set():
+                        chunk = f.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        chunk = remainder + chunk
+                        end = chunk.rfind(b"\n") + 1
+                        remainder = chunk[end:]
+                        if end:
+                            found += self._put(self._parse(chunk[:end]))
+                if remainder:
+                    found += self._put(self._parse(remainder))
+                if not self.repeat:
+                    break
+                if not found:
+                    # replaying a file without domains would only spin
+                    logger.warning(f"No domains in {self.filename}, stopping the replay")
+                    break
+        except Exception:
+            logger.exception(f"Failed to read {self.filename}")
+        self._put(None)
+
+    def _put(self, block: list[str] | None) -> int:
+        """Queues the block for the polls, returns the number of domains in it."""
+        if block is not None and not block:
+            return 0
+        while not self._closed.is_set():
+            try:
+                self._blocks.put(block, timeout=READ_WAIT_S)
+                break
+            except queue.Full:
+                continue
+        return len(block) if block is not None else 0
+
+    def _parse(self, data: bytes) -> list[str]:
+        lines = data.decode(errors="replace").splitlines()
+        if self.format == FORMAT_TEXT:
+            return [line for line in map(str.strip, lines) if line]
+
+        domains = []
+        skipped = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                value = get_field(json.loads(line), self.field)
+            except (ValueError, KeyError, TypeError):
+                skipped += 1
+                continue
+            if isinstance(value, str):
+                domains.append(value)
+            elif isinstance(value, list):
+                domains.extend(item for item in value if isinstance(item, str))
+            else:
+                skipped += 1
+        if skipped:
+            logger.debug(f"Skipped {skipped} malformed lines of {self.filename}")
+        return domains
 
     def _make_next(self):
         self._next = time.monotonic_ns() + self.delay * MS + self._rnd.randint(0, self.jitter * MS)
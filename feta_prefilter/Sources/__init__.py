@@ -3,6 +3,7 @@ from .StreamingFileSource import StreamingFileSource
 from .ELKSource import ELKSource
 from .CesnetELKSource import CesnetELKSource
 from .MISPSource import MISPSource
+from .KafkaSource import KafkaSource
 
 source_classes = {
     'SimpleFileSource': SimpleFileSource,
@@ -10,4 +11,5 @@ source_classes = {
     'ELKSource': ELKSource,
     'CesnetELKSource': CesnetELKSource,
     'MISPSource': MISPSource,
+    'KafkaSource': KafkaSource,
 }
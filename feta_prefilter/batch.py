@@ -0,0 +1,124 @@
+from array import array
+from typing import Iterable, Iterator
+
+from feta_prefilter.Filters.BaseFilter import FilterAction
+
+
+class DomainBatch:
+    """Filtered domains of one batch in columnar form.
+
+    `domains` holds the names, `verdicts` the highest action of all filters
+    for each name and `hits` how many times each name occurred, if known.
+    `results` is a row-major matrix of the actions of the filters named in
+    `filter_names`, one row per name. Only the rows of names with the STORE
+    verdict are filled, since only their filter results are passed on.
+
+    The actions are kept as bytes, so a batch takes a handful of allocations
+    instead of a few dicts per domain. Outputs build the dicts only for the
+    rows that need them, see `f_results` and `domain_info`. Iterating over the
+    batch yields the dicts of all rows.
+    """
+
+    __slots__ = ("domains", "verdicts", "filter_names", "results", "hits")
+
+    def __init__(
+        self,
+        domains: list[str],
+        verdicts: array,
+        filter_names: tuple[str, ...],
+        results: array | None = None,
+        hits: array | None = None,
+    ):
+        self.domains = domains
+        self.verdicts = verdicts
+        self.filter_names = filter_names
+        self.results = results if results is not None else array("B", bytes(len(domains) * len(filter_names)))
+        self.hits = hits
+
+    @classmethod
+    def empty(cls, filter_names: tuple[str, ...] = ()) -> "DomainBatch":
+        return cls([], array("B"), filter_names)
+
+    def __len__(self) -> int:
+        return len(self.domains)
+
+    def __iter__(self) -> Iterator[dict]:
+        return (self.domain_info(i) for i in range(len(self.domains)))
+
+    def set_results(self, i: int, actions: Iterable[int]) -> None:
+        width = len(self.filter_names)
+        self.results[i * width:(i + 1) * width] = array("B", actions)
+
+    def f_results(self, i: int) -> dict[str, FilterAction]:
+        """The actions of the filters by their names, empty unless the verdict is STORE."""
+        if self.verdicts[i] != FilterAction.STORE:
+            return {}
+        width = len(self.filter_names)
+        row = self.results[i * width:(i + 1) * width]
+        return {name: FilterAction(action) for name, action in zip(self.filter_names, row)}
+
+    def domain_info(self, i: int) -> dict:
+        """The row as ``{"domain", "f_results", "hits"}``, ``hits`` only when known."""
+        domain_info = {"domain": self.domains[i], "f_results": self.f_results(i)}
+        if self.hits is not None:
+            domain_info["hits"] = self.hits[i]
+        return domain_info
+
+    def stored_positions(self) -> list[int]:
+        return [i for i, verdict in enumerate(self.verdicts) if verdict == FilterAction.STORE]
+
+    def take(self, positions: list[int]) -> "DomainBatch":
+        res = DomainBatch(
+            [self.domains[i] for i in positions],
+            array("B", [self.verdicts[i] for i in positions]),
+            self.filter_names,
+            hits=array("q", [self.hits[i] for i in positions]) if self.hits is not None else None,
+        )
+        # only the rows of stored names hold results, the others stay zero
+        width = len(self.filter_names)
+        for row, i in enumerate(positions):
+            if self.verdicts[i] == FilterAction.STORE:
+                res.results[row * width:(row + 1) * width] = self.results[i * width:(i + 1) * width]
+        return res
+
+    @classmethod
+    def concat(cls, batches: Iterable["DomainBatch"]) -> "DomainBatch":
+        """Joins the batches in order.
+
+        Batches filtered by different sets of filters, e.g. before and after a
+        configuration change, get the union of the filter columns, where the
+        filters missing in a batch are PASS.
+        """
+        batches = [batch for batch in batches if len(batch)]
+        if not batches:
+            return cls.empty()
+        if len(batches) == 1:
+            return batches[0]
+
+        domains = []
+        verdicts = array("B")
+        for batch in batches:
+            domains.extend(batch.domains)
+            verdicts.extend(batch.verdicts)
+        hits = None
+        if all(batch.hits is not None for batch in batches):
+            hits = array("q")
+            for batch in batches:
+                hits.extend(batch.hits)
+
+        filter_names = batches[0].filter_names
+        if all(batch.filter_names == filter_names for batch in batches):
+            results = array("B")
+            for batch in batches:
+                results.extend(batch.results)
+            return cls(domains, verdicts, filter_names, results, hits)
+
+        filter_names = tuple(dict.fromkeys(name for batch in batches for name in batch.filter_names))
+        res = cls(domains, verdicts, filter_names, hits=hits)
+        offset = 0
+        for batch in batches:
+            for i in batch.stored_positions():
+                actions = batch.f_results(i)
+                res.set_results(offset + i, (actions.get(name, FilterAction.PASS) for name in filter_names))
+            offset += len(batch)
+        return res
@@ -0,0 +1,379 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from importlib import metadata
+from typing import Callable
+
+from feta_prefilter.batch import DomainBatch
+from feta_prefilter.dedup import DedupCache, Deduplicator
+from feta_prefilter.Filters import FileBlockListFilter, RandomDROPFilter, SnapshotBlockListFilter, ValidDomainFilter
+from feta_prefilter.Filters.BaseFilter import FilterAction
+from feta_prefilter.Filters.BlockListSnapshot import BlockListSnapshot, write_snapshot
+from feta_prefilter.Filters.SuffixBloom import SuffixBloom
+from feta_prefilter.Outputs.BaseOutput import BaseOutput
+from feta_prefilter.Sources.BaseSource import BaseSource
+from feta_prefilter.normalize import normalize_batch
+from feta_prefilter.pipeline import FilterPipeline
+from feta_prefilter.runner import PipelineRunner
+
+logger = logging.getLogger(__name__)
+
+# rough shares of the TLDs in DNS traffic
+TLD_WEIGHTS = {
+    "com": 46, "net": 7, "org": 5, "de": 4, "ru": 4, "co.uk": 3, "cz": 3, "br": 2, "jp": 2, "io": 2,
+    "info": 2, "cn": 2, "fr": 2, "nl": 2, "xyz": 2, "top": 2, "pl": 2, "it": 2, "sk": 1, "eu": 1,
+}
+SUBDOMAIN_LABELS = ["www", "mail", "api", "cdn", "m", "static", "img", "login", "app", "ns1", "smtp", "dev"]
+# number of labels in front of the registered domain
+SUBDOMAIN_DEPTH_WEIGHTS = [35, 40, 15, 7, 3]
+LABEL_LENGTH_WEIGHTS = [2, 5, 9, 12, 13, 12, 10, 9, 7, 6, 5, 4, 3, 2, 1]  # lengths 2 to 16
+LETTERS = "etaoinshrdlcumwfgypbvkjxqz0123456789-"
+LETTER_WEIGHTS = [12, 9, 8, 8, 7, 7, 6, 6, 6, 4, 4, 3, 3, 2, 2, 2, 2, 2, 2, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
+# marks the first domain of every batch fed to the runner, see `bench_runner`
+SENTINEL_SUFFIX = "bench-sentinel.test"
+
+
+def random_label(rng: random.Random) -> str:
+    length = rng.choices(range(2, 17), LABEL_LENGTH_WEIGHTS)[0]
+    label = "".join(rng.choices(LETTERS, LETTER_WEIGHTS, k=length)).strip("-")
+    return label or "x"
+
+
+def generate_registered(count: int, rng: random.Random) -> list[str]:
+    tlds = list(TLD_WEIGHTS)
+    tld_weights = list(TLD_WEIGHTS.values())
+    return [f"{random_label(rng)}.{rng.choices(tlds, tld_weights)[0]}" for _ in range(count)]
+
+
+def generate_pool(count: int, rng: random.Random) -> list[str]:
+    """Generates unique domain names, several subdomains share a registered domain."""
+    registered = generate_registered(max(1, count // 3), rng)
+    pool = set()
+    while len(pool) < count:
+        labels = [rng.choice(registered)]
+        for _ in range(rng.choices(range(len(SUBDOMAIN_DEPTH_WEIGHTS)), SUBDOMAIN_DEPTH_WEIGHTS)[0]):
+            labels.append(rng.choice(SUBDOMAIN_LABELS) if rng.random() < 0.6 else random_label(rng))
+        pool.add(".".join(reversed(labels)))
+    return list(pool)
+
+
+def generate_corpus(pool: list[str], size: int, rng: random.Random, zipf_s: float = 1.1,
+                    junk_rate: float = 0.01) -> list[str]:
+    """Samples DNS queries from the pool with Zipf-distributed popularity, with some malformed names."""
+    cum_weights = []
+    total = 0.0
+    for rank in range(1, len(pool) + 1):
+        total += rank ** -zipf_s
+        cum_weights.append(total)
+
+    corpus = rng.choices(pool, cum_weights=cum_weights, k=size)
+    for i in rng.sample(range(size), int(size * junk_rate)):
+        kind = rng.randrange(3)
+        if kind == 0:
+            corpus[i] = corpus[i].upper() + "."
+        elif kind == 1:
+            corpus[i] = f"-{corpus[i]}"
+        else:
+            corpus[i] = f"{random_label(rng)}_{random_label(rng)}"
+    return corpus
+
+
+def generate_blocklist(pool: list[str], size: int, rng: random.Random, hit_rate: float = 0.3) -> list[str]:
+    """Lists registered domains and hosts of the pool, the rest are domains never queried."""
+    hits = rng.sample(pool, min(len(pool), int(size * hit_rate)))
+    # half of the listed pool domains block all their subdomains through the registered domain
+    hits = [".".join(domain.split(".")[-2:]) if i % 2 else domain for i, domain in enumerate(hits)]
+    return hits + generate_registered(size - len(hits), rng)
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def peak_rss_bytes() -> int:
+    # kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def measure(batches: list, fn: Callable) -> dict:
+    latencies = []
+    domains = 0
+    start = time.perf_counter()
+    for batch in batches:
+        batch_start = time.perf_counter()
+        fn(batch)
+        latencies.append(time.perf_counter() - batch_start)
+        domains += len(batch)
+    return summarize(domains, time.perf_counter() - start, latencies)
+
+
+def summarize(domains: int, seconds: float, latencies: list[float]) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "domains": domains,
+        "batches": len(latencies),
+        "seconds": seconds,
+        "domains_per_s": domains / seconds if seconds else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+class Workload:
+    """Synthetic corpus and blocklist shared by the benchmarks."""
+
+    def __init__(self, args: argparse.Namespace, workdir: str):
+        rng = random.Random(args.seed)
+        started = time.perf_counter()
+        pool = generate_pool(args.unique, rng)
+        corpus = generate_corpus(pool, args.domains, rng)
+        self.batches = [corpus[i:i + args.batch_size] for i in range(0, len(corpus), args.batch_size)]
+        self.blocklist = generate_blocklist(pool, args.blocklist_size, rng)
+        self.workers = args.workers
+
+        self.blocklist_path = os.path.join(workdir, "blocklist.txt")
+        with open(self.blocklist_path, "w") as f:
+            f.write("\n".join(self.blocklist))
+        self.snapshot_path = os.path.join(workdir, "blocklist.snap")
+        write_snapshot(self.snapshot_path, self.blocklist)
+        # the same snapshot with a pre-screen, picked up from <snapshot>.bloom
+        self.prescreen_snapshot_path = os.path.join(workdir, "blocklist-prescreen.snap")
+        write_snapshot(self.prescreen_snapshot_path, self.blocklist)
+        snapshot = BlockListSnapshot(self.prescreen_snapshot_path)
+        SuffixBloom.from_entries(snapshot.entries(), 0.01).save(f"{self.prescreen_snapshot_path}.bloom", snapshot.digest)
+        snapshot.close()
+        logger.info("Generated %d domains and a blocklist of %d in %.1f s",
+                    len(corpus), len(self.blocklist), time.perf_counter() - started)
+
+    def filters(self) -> list:
+        return [
+            FileBlockListFilter("blocklist", FilterAction.DROP, self.blocklist_path),
+            ValidDomainFilter("valid"),
+            RandomDROPFilter("random", FilterAction.STORE, drop_rate=1.0),
+        ]
+
+
+def bench_normalize(workload: Workload) -> dict:
+    return measure(workload.batches, normalize_batch)
+
+
+def filter_benchmark(create: Callable[[Workload], object]) -> Callable[[Workload], dict]:
+    def bench(workload: Workload) -> dict:
+        setup_start = time.perf_counter()
+        f = create(workload)
+        setup_s = time.perf_counter() - setup_start
+        normalized = [normalize_batch(batch) for batch in workload.batches]
+        return {"setup_s": setup_s, **measure(normalized, f.filter_batch)}
+    return bench
+
+
+def bench_pipeline(workload: Workload, workers: int = 0, short_circuit: bool = False) -> dict:
+    setup_start = time.perf_counter()
+    pipeline = FilterPipeline(workload.filters(), short_circuit=short_circuit, workers=workers)
+    pipeline.build_index()
+    setup_s = time.perf_counter() - setup_start
+    try:
+        return {"setup_s": setup_s, **measure(workload.batches, pipeline.run)}
+    finally:
+        pipeline.close()
+
+
+def bench_dedup(workload: Workload) -> dict:
+    pipeline = FilterPipeline([])
+    filtered = [pipeline.run(batch) for batch in workload.batches]
+    deduplicator = Deduplicator(DedupCache())
+
+    def deduplicate(batch):
+        deduplicator.commit(deduplicator.process(batch))
+
+    res = measure(filtered, deduplicate)
+    res["hit_rate"] = deduplicator.cache.hit_rate
+    return res
+
+
+class ListSource(BaseSource):
+    def __init__(self, batches: list[list[str]]):
+        self.batches = batches
+        self.position = 0
+        self.enqueued: dict[str, float] = {}
+
+    def collect(self) -> list[str]:
+        if self.position == len(self.batches):
+            return []
+        sentinel = f"b{self.position}.{SENTINEL_SUFFIX}"
+        batch = [sentinel] + self.batches[self.position]
+        self.enqueued[sentinel] = time.perf_counter()
+        self.position += 1
+        return batch
+
+
+class SentinelOutput(BaseOutput):
+    def __init__(self, expected: int):
+        self.latencies = []
+        self.domains = 0
+        self.expected = expected
+        self.done = threading.Event()
+        self.source: ListSource | None = None
+
+    def output(self, domains: DomainBatch) -> list[str]:
+        now = time.perf_counter()
+        self.domains += len(domains)
+        for domain in domains.domains:
+            if domain.endswith(SENTINEL_SUFFIX):
+                self.latencies.append(now - self.source.enqueued[domain])
+        if len(self.latencies) == self.expected:
+            self.done.set()
+        return []
+
+
+class BenchApp:
+    def __init__(self, sources: list, filters: list, outputs: list, workers: int):
+        self.sources = sources
+        self.filters = filters
+        self.outputs = outputs
+        self.pipeline = FilterPipeline(filters, workers=workers)
+        self.pipeline.build_index()
+        self.checkpoint_keys = {}
+
+
+def bench_runner(workload: Workload) -> dict:
+    """Runs the source, filter and output stages of `main()` on the corpus.
+
+    The latency of a batch is the time from its collection until the output
+    stage received it. Batches may be coalesced by the filter stage.
+    """
+    source = ListSource(workload.batches)
+    output = SentinelOutput(len(workload.batches))
+    output.source = source
+    # the sentinels are not blocked, valid domain names
+    app = BenchApp([source], workload.filters()[:2], [output], workload.workers)
+
+    runner = PipelineRunner(app)
+    start = time.perf_counter()
+    runner.start()
+    output.done.wait(timeout=3600)
+    seconds = time.perf_counter() - start
+    runner.stop()
+    app.pipeline.close()
+
+    res = summarize(sum(len(batch) for batch in workload.batches), seconds, output.latencies)
+    res["output_domains"] = output.domains
+    return res
+
+
+BENCHMARKS: dict[str, Callable[[Workload], dict]] = {
+    "normalize": bench_normalize,
+    "filter/FileBlockListFilter": filter_benchmark(
+        lambda w: FileBlockListFilter("blocklist", FilterAction.DROP, w.blocklist_path)
+    ),
+    "filter/SnapshotBlockListFilter": filter_benchmark(
+        lambda w: SnapshotBlockListFilter("blocklist", FilterAction.DROP, w.snapshot_path)
+    ),
+    "filter/SnapshotBlockListFilter+prescreen": filter_benchmark(
+        lambda w: SnapshotBlockListFilter("blocklist", FilterAction.DROP, w.prescreen_snapshot_path)
+    ),
+    "filter/ValidDomainFilter": filter_benchmark(lambda w: ValidDomainFilter("valid")),
+    "filter/RandomDROPFilter": filter_benchmark(lambda w: RandomDROPFilter("random", drop_rate=50.0)),
+    "stage/pipeline": lambda w: bench_pipeline(w),
+    "stage/pipeline-short-circuit": lambda w: bench_pipeline(w, short_circuit=True),
+    "stage/pipeline-workers": lambda w: bench_pipeline(w, workers=w.workers),
+    "stage/dedup": bench_dedup,
+    "stage/runner": bench_runner,
+}
+
+
+def _run_child(name: str, workload: Workload, conn) -> None:
+    try:
+        res = BENCHMARKS[name](workload)
+        res["peak_rss_bytes"] = peak_rss_bytes()
+        conn.send(res)
+    except Exception as e:
+        logger.exception("Benchmark %s failed", name)
+        conn.send({"error": repr(e)})
+    finally:
+        conn.close()
+
+
+def run_isolated(name: str, workload: Workload) -> dict:
+    """Runs the benchmark in a forked process, so that its peak RSS is not shared with the others."""
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_run_child, args=(name, workload, child_conn))
+    process.start()
+    child_conn.close()
+    try:
+        res = parent_conn.recv()
+    except EOFError:
+        res = {"error": f"benchmark process exited with {process.exitcode}"}
+    process.join()
+    return {"name": name, **res}
+
+
+def package_version() -> str | None:
+    try:
+        return metadata.version("prefilter")
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the filters and the pipeline stages on synthetic data.")
+    parser.add_argument("--domains", type=int, default=1_000_000, help="number of domains in the corpus")
+    parser.add_argument("--unique", type=int, default=200_000, help="number of distinct domains in the corpus")
+    parser.add_argument("--blocklist-size", type=int, default=100_000, help="number of blocklist entries")
+    parser.add_argument("--batch-size", type=int, default=10_000, help="number of domains per batch")
+    parser.add_argument("--workers", type=int, default=4, help="filter worker processes of stage/pipeline-workers")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic data")
+    parser.add_argument("--only", action="append", default=[],
+                        help="run only the benchmarks whose name contains the text, repeatable")
+    parser.add_argument("--output", default=None, help="path of the JSON report, printed to stdout by default")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.environ.get("DOMAINRADAR_LOG_LEVEL", "WARNING"))
+
+    names = [name for name in BENCHMARKS if not args.only or any(part in name for part in args.only)]
+    with tempfile.TemporaryDirectory(prefix="prefilter-benchmark-") as workdir:
+        workload = Workload(args, workdir)
+        results = []
+        for name in names:
+            res = run_isolated(name, workload)
+            results.append(res)
+            if "error" in res:
+                print(f"{name:40} failed: {res['error']}", file=sys.stderr)
+            else:
+                print(
+                    f"{name:40} {res['domains_per_s']:>12,.0f} domains/s  p50 {res['p50_ms']:8.2f} ms"
+                    f"  p99 {res['p99_ms']:8.2f} ms  peak RSS {res['peak_rss_bytes'] / 2 ** 20:8.1f} MiB",
+                    file=sys.stderr,
+                )
+
+    report = {
+        "version": package_version(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": vars(args),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
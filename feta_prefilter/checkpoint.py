@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from kafka import KafkaConsumer, KafkaProducer
+
+from feta_prefilter.utils import make_ssl_context
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointStore:
+    """Durable store of the source cursors.
+
+    The cursors are JSON-serializable dicts keyed by the checkpoint key of
+    their source. They are read once when the store is created, `update`
+    changes them in memory and `flush` persists the changed ones.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cursors: dict[str, dict] = self._read()
+        self._dirty: set[str] = set()
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            return self._cursors.get(key)
+
+    def update(self, cursors: dict[str, dict]) -> None:
+        with self._lock:
+            self._cursors.update(cursors)
+            self._dirty.update(cursors)
+
+    def flush(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            changed = {key: self._cursors[key] for key in self._dirty}
+            self._dirty.clear()
+            self._write(self._cursors, changed)
+
+    def _read(self) -> dict[str, dict]:
+        raise NotImplementedError()
+
+    def _write(self, cursors: dict[str, dict], changed: dict[str, dict]) -> None:
+        raise NotImplementedError()
+
+
+class FileCheckpointStore(CheckpointStore):
+    """Keeps the cursors in a JSON file that is replaced atomically on every flush."""
+
+    def __init__(self, path: str):
+        self.path = path
+        super().__init__()
+
+    def _read(self) -> dict[str, dict]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write(self, cursors: dict[str, dict], changed: dict[str, dict]) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cursors, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    """Keeps the cursors in an SQLite database, a flush is a single transaction."""
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS checkpoints (key TEXT PRIMARY KEY, cursor TEXT NOT NULL)")
+        super().__init__()
+
+    def _read(self) -> dict[str, dict]:
+        return {key: json.loads(cursor) for key, cursor in self._conn.execute("SELECT key, cursor FROM checkpoints")}
+
+    def _write(self, cursors: dict[str, dict], changed: dict[str, dict]) -> None:
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO checkpoints (key, cursor) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET cursor = excluded.cursor",
+                [(key, json.dumps(cursor)) for key, cursor in changed.items()],
+            )
+
+
+class KafkaCheckpointStore(CheckpointStore):
+    """Keeps the cursors as messages keyed by the source in a (compacted) Kafka topic."""
+
+    def __init__(self, topic: str, kafka_broker: str, kafka_secrets_dir: str):
+        self.topic = topic
+        self._kafka_options = {
+            "bootstrap_servers": kafka_broker,
+            "security_protocol": "SSL",
+            "ssl_context": make_ssl_context(Path(kafka_secrets_dir)),
+        }
+        self._producer = KafkaProducer(client_id="loader-checkpoints", acks="all", **self._kafka_options)
+        super().__init__()
+
+    def _read(self) -> dict[str, dict]:
+        consumer = KafkaConsumer(
+            self.topic,
+            client_id="loader-checkpoints-init",
+            auto_offset_reset="earliest",
+            consumer_timeout_ms=500,
+            **self._kafka_options,
+        )
+        cursors = {}
+        for msg in consumer:
+            try:
+                cursors[msg.key.decode()] = json.loads(msg.value)
+            except (AttributeError, UnicodeDecodeError, json.JSONDecodeError):
+                continue
+        consumer.close()
+        return cursors
+
+    def _write(self, cursors: dict[str, dict], changed: dict[str, dict]) -> None:
+        for key, cursor in changed.items():
+            self._producer.send(self.topic, key=key.encode(), value=json.dumps(cursor).encode())
+        self._producer.flush()
+
+
+def create_checkpoint_store(checkpoint_config: dict, config: dict) -> CheckpointStore:
+    """Creates the store described by the ``checkpoint`` object of the pipeline config."""
+    store_type = checkpoint_config.get("type", "file")
+    if store_type == "file":
+        return FileCheckpointStore(checkpoint_config["path"])
+    elif store_type == "sqlite":
+        return SQLiteCheckpointStore(checkpoint_config["path"])
+    elif store_type == "kafka":
+        return KafkaCheckpointStore(
+            checkpoint_config.get("topic", "loader_checkpoints"),
+            config["kafka_broker"],
+            config["kafka_secrets_dir"],
+        )
+    raise ValueError(f"Unknown checkpoint store type {store_type}")
@@ -0,0 +1,82 @@
+import argparse
+import csv
+import json
+import logging
+import sys
+from typing import Iterable, TextIO
+from urllib.parse import urlparse
+
+from feta_prefilter.Filters.BlockListSnapshot import BlockListSnapshot, write_snapshot
+from feta_prefilter.Filters.SuffixBloom import SuffixBloom
+
+logger = logging.getLogger(__name__)
+
+
+def read_text(f: TextIO) -> Iterable[str]:
+    return f
+
+
+def read_csv(f: TextIO, column: int) -> Iterable[str]:
+    for row in csv.reader(f):
+        if len(row) > column:
+            yield row[column]
+
+
+def read_misp(f: TextIO) -> Iterable[str]:
+    """Reads domains from a JSON export of MISP attributes (the result of an attributes search)."""
+    export = json.load(f)
+    if "response" in export:
+        export = export["response"]
+    for attr in export.get("Attribute", []):
+        if attr["type"] == "domain":
+            yield attr["value"]
+        elif attr["type"] == "url":
+            yield urlparse(attr["value"]).netloc
+
+
+def read_domains(paths: list[str], input_format: str, csv_column: int) -> Iterable[str]:
+    for path in paths:
+        with (open(path) if path != "-" else sys.stdin) as f:
+            if input_format == "csv":
+                yield from read_csv(f, csv_column)
+            elif input_format == "misp":
+                yield from read_misp(f)
+            else:
+                yield from read_text(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compiles blocklists into a memory-mapped snapshot for SnapshotBlockListFilter."
+    )
+    parser.add_argument("output", help="path of the snapshot to write")
+    parser.add_argument("inputs", nargs="+", help="blocklists to compile, - reads the standard input")
+    parser.add_argument(
+        "--format",
+        choices=("text", "csv", "misp"),
+        default="text",
+        help="text: one domain per line, csv: e.g. a Postgres COPY export, misp: JSON export of MISP attributes",
+    )
+    parser.add_argument("--csv-column", type=int, default=0, help="column with the domain in CSV inputs")
+    parser.add_argument(
+        "--prescreen-fp-rate",
+        type=float,
+        default=None,
+        help="also write a Bloom filter pre-screen with this false positive rate to <output>.bloom",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    count = write_snapshot(args.output, read_domains(args.inputs, args.format, args.csv_column))
+    logger.info("Wrote %d entries to %s", count, args.output)
+
+    if args.prescreen_fp_rate is not None:
+        snapshot = BlockListSnapshot(args.output)
+        bloom = SuffixBloom.from_entries(list(snapshot.entries()), args.prescreen_fp_rate)
+        bloom.save(f"{args.output}.bloom", snapshot.digest)
+        snapshot.close()
+        logger.info("Wrote pre-screen to %s.bloom", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+import logging
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from collections import deque
+from typing import Iterable
+
+from feta_prefilter.Filters.BaseFilter import FilterAction
+from feta_prefilter.batch import DomainBatch
+
+logger = logging.getLogger(__name__)
+
+# rough size of an int object referenced from the set of the current generation
+_INT_SIZE = 32
+
+
+class DedupCache:
+    """Bounded, time-expiring set of recently emitted domains.
+
+    Domains are kept as 64-bit hashes in generations spanning `ttl_s /
+    generations` seconds each. The current generation is a set, older ones are
+    sealed into sorted arrays taking 8 bytes per domain and searched with
+    bisection. A generation is dropped once it is older than the TTL.
+
+    While the cache holds more than `max_entries` domains, the oldest
+    generations are evicted early with a second chance: the domains looked up
+    since their generation was sealed are moved to the current generation
+    instead of being dropped, so the least recently used domains go first.
+
+    The hashes come from the built-in `hash`, the cache must not be shared
+    between processes.
+    """
+
+    def __init__(self, ttl_s: float = 3600.0, max_entries: int = 10_000_000, generations: int = 8):
+        assert ttl_s > 0, "ttl_s must be positive"
+        assert max_entries > 0, "max_entries must be positive"
+        assert generations > 0, "generations must be positive"
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self._generation_s = ttl_s / generations
+
+        self._active: set[int] = set()
+        self._active_start = time.monotonic()
+        # (time of sealing, sorted hashes, hashes looked up since), oldest first
+        self._sealed: deque[tuple[float, array, set[int]]] = deque()
+        self._sealed_entries = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._active) + self._sealed_entries
+
+    def contains_many(self, domains: Iterable[str]) -> list[bool]:
+        """Returns for each of the domains whether it is in the cache, without adding them."""
+        self._rotate(time.monotonic())
+        res = [self._find(hash(domain)) for domain in domains]
+        found = sum(res)
+        self.hits += found
+        self.misses += len(res) - found
+        return res
+
+    def add_many(self, domains: Iterable[str]) -> list[bool]:
+        """Adds the domains, returns for each of them whether it was not in the cache yet."""
+        self._rotate(time.monotonic())
+        active = self._active
+
+        res = []
+        for domain in domains:
+            key = hash(domain)
+            new = not self._find(key)
+            if new:
+                active.add(key)
+            res.append(new)
+
+        added = sum(res)
+        self.misses += added
+        self.hits += len(res) - added
+        self._enforce_limit()
+        return res
+
+    def insert_many(self, domains: Iterable[str]) -> None:
+        """Adds the domains as emitted now, e.g. after `contains_many` found them missing."""
+        self._rotate(time.monotonic())
+        self._active.update(hash(domain) for domain in domains)
+        self._enforce_limit()
+
+    def _find(self, key: int) -> bool:
+        if key in self._active:
+            return True
+        for _, hashes, used in reversed(self._sealed):
+            i = bisect_left(hashes, key)
+            if i < len(hashes) and hashes[i] == key:
+                used.add(key)
+                return True
+        return False
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def memory_usage(self) -> int:
+        """Approximate number of bytes held by the cache."""
+        size = sys.getsizeof(self._active) + len(self._active) * _INT_SIZE
+        for _, hashes, used in self._sealed:
+            size += sys.getsizeof(hashes) + sys.getsizeof(used) + len(used) * _INT_SIZE
+        return size
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "memory_bytes": self.memory_usage(),
+        }
+
+    def _seal(self, now: float) -> None:
+        hashes = array("q", sorted(self._active))
+        self._sealed.append((now, hashes, set()))
+        self._sealed_entries += len(hashes)
+        self._active = set()
+        self._active_start = now
+
+    def _drop_oldest(self) -> None:
+        _, hashes, _ = self._sealed.popleft()
+        self._sealed_entries -= len(hashes)
+
+    def _evict_oldest(self) -> None:
+        _, hashes, used = self._sealed.popleft()
+        self._sealed_entries -= len(hashes)
+        # the used domains get a second chance in the current generation and have to be used again to keep it
+        self._active.update(used)
+
+    def _rotate(self, now: float) -> None:
+        if now - self._active_start >= self._generation_s:
+            self._seal(now)
+        while self._sealed and self._sealed[0][0] <= now - self.ttl_s:
+            self._drop_oldest()
+
+    def _enforce_limit(self) -> None:
+        if len(self) <= self.max_entries:
+            return
+        if len(self._active) > self.max_entries // 2:
+            self._seal(time.monotonic())
+        while self._sealed and len(self) > self.max_entries:
+            self._evict_oldest()
+
+
+class Deduplicator:
+    """Suppresses filtered domains that were already passed to the outputs.
+
+    Domains emitted within the TTL of the cache are left out of the batch by
+    `process`. The kept domains enter the cache only through `commit`, called
+    once the outputs wrote them, so a failed batch is not suppressed when its
+    domains come again. With
+    `refresh_interval_s` set, the suppressed domains are collected and emitted
+    again once per interval, which lets e.g. `PostgresOutput` update their last
+    seen time at a lower rate.
+    """
+
+    # how often the cache statistics are logged
+    REPORT_INTERVAL_S = 60.0
+
+    def __init__(self, cache: DedupCache, refresh_interval_s: float | None = None):
+        self.cache = cache
+        self.refresh_interval_s = refresh_interval_s
+        # suppressed domains with their verdict, filter names, results row and hits since they were last
+        # emitted; only the row is kept, not the batch it came in
+        self._pending_refresh: dict[str, tuple[int, tuple[str, ...], bytes, int | None]] = {}
+        self._next_refresh = time.monotonic() + (refresh_interval_s or 0.0)
+        self._next_report = time.monotonic() + self.REPORT_INTERVAL_S
+
+    @classmethod
+    def from_config(cls, dedup_config: dict) -> "Deduplicator":
+        cache = DedupCache(
+            ttl_s=dedup_config.get("ttl_s", 3600.0),
+            max_entries=dedup_config.get("max_entries", 10_000_000),
+            generations=dedup_config.get("generations", 8),
+        )
+        return cls(cache, refresh_interval_s=dedup_config.get("refresh_interval_s"))
+
+    def process(self, filtered_domains: DomainBatch) -> DomainBatch:
+        domains = filtered_domains.domains
+        hits = filtered_domains.hits
+        emitted = self.cache.contains_many(domains)
+
+        kept = []
+        refresh = self.refresh_interval_s is not None
+        verdicts = filtered_domains.verdicts
+        filter_names = filtered_domains.filter_names
+        width = len(filter_names)
+        for i, seen in enumerate(emitted):
+            if not seen:
+                kept.append(i)
+                if refresh:
+                    self._pending_refresh.pop(domains[i], None)
+            elif refresh:
+                domain_hits = hits[i] if hits is not None else None
+                pending = self._pending_refresh.get(domains[i])
+                if pending is not None and pending[3] is not None and domain_hits is not None:
+                    # the refresh reports the occurrences since the domain was last emitted
+                    domain_hits += pending[3]
+                verdict = verdicts[i]
+                row = b""
+                if verdict == FilterAction.STORE:
+                    # only the rows of stored names hold results, see `DomainBatch`
+                    row = filtered_domains.results[i * width:(i + 1) * width].tobytes()
+                self._pending_refresh[domains[i]] = (verdict, filter_names, row, domain_hits)
+        res = filtered_domains if len(kept) == len(domains) else filtered_domains.take(kept)
+
+        now = time.monotonic()
+        if refresh and now >= self._next_refresh:
+            res = DomainBatch.concat([res, self._take_pending_refresh()])
+            self._next_refresh = now + self.refresh_interval_s
+
+        if now >= self._next_report:
+            logger.info("Dedup cache: %s", self.cache.stats())
+            self._next_report = now + self.REPORT_INTERVAL_S
+        return res
+
+    def commit(self, emitted_domains: DomainBatch) -> None:
+        """Adds the domains of a batch returned by `process` to the cache once they were output."""
+        self.cache.insert_many(emitted_domains.domains)
+
+    def _take_pending_refresh(self) -> DomainBatch:
+        # the suppressed rows are rebuilt into one batch per set of filters
+        rows_by_filters: dict[tuple[str, ...], list[tuple[str, int, bytes, int | None]]] = {}
+        for domain, (verdict, filter_names, row, hits) in self._pending_refresh.items():
+            rows_by_filters.setdefault(filter_names, []).append((domain, verdict, row, hits))
+        self._pending_refresh = {}
+
+        parts = []
+        for filter_names, rows in rows_by_filters.items():
+            all_hits = [hits for _, _, _, hits in rows]
+            part = DomainBatch(
+                [domain for domain, _, _, _ in rows],
+                array("B", [verdict for _, verdict, _, _ in rows]),
+                filter_names,
+                hits=array("q", all_hits) if None not in all_hits else None,
+            )
+            width = len(filter_names)
+            for i, (_, _, row, _) in enumerate(rows):
+                if row:
+                    part.results[i * width:(i + 1) * width] = array("B", row)
+            parts.append(part)
+        return DomainBatch.concat(parts)
@@ -0,0 +1,46 @@
+import os
+
+# bytes before the read offset kept to recognize a file rewritten in place
+TAIL_BYTES = 64
+
+
+def read_appended_lines(path: str, position: dict | None) -> tuple[list[str], dict] | None:
+    """Reads the lines appended to the file since `position`, the whole file if it is None.
+
+    Returns the lines and the position after them. The position holds the
+    inode, size and modification time of the file and the last bytes read, all
+    JSON-serializable. None means that the file was replaced, truncated or
+    rewritten in place since the position and has to be read from the start.
+    A file whose size and modification time did not change is not read at all.
+
+    When reading from a position, a last line without a line break may still
+    be being written, so it is left for the next call and only read once the
+    file did not change between two calls. The whole file is read as it is.
+    """
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        if position is None:
+            offset = 0
+            tail = b""
+        else:
+            offset = position["offset"]
+            tail = bytes.fromhex(position["tail"])
+            if st.st_ino != position["inode"] or st.st_size < offset:
+                return None
+            if st.st_size == offset and st.st_mtime_ns == position["mtime_ns"]:
+                return [], position
+            f.seek(offset - len(tail))
+            if f.read(len(tail)) != tail:
+                return None
+        data = f.read()
+
+    if position is not None and (st.st_size != position.get("size") or st.st_mtime_ns != position["mtime_ns"]):
+        data = data[:data.rfind(b"\n") + 1]
+    lines = [line.strip() for line in data.decode(errors="replace").splitlines()]
+    return [line for line in lines if line], {
+        "inode": st.st_ino,
+        "offset": offset + len(data),
+        "tail": (tail + data)[-TAIL_BYTES:].hex(),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+    }
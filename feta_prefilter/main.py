@@ -5,17 +5,23 @@ import logging
 from pathlib import Path
 from pprint import pprint
 import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from json import JSONDecodeError
 
 from kafka import KafkaConsumer, KafkaProducer
 
 from feta_prefilter.utils import make_ssl_context
+from feta_prefilter.checkpoint import create_checkpoint_store
+from feta_prefilter.dedup import Deduplicator
+from feta_prefilter.metrics import start_http_server, start_kafka_publisher
+from feta_prefilter.profiler import start_profile
+from feta_prefilter.pipeline import FilterPipeline
+from feta_prefilter.runner import PipelineRunner
 from feta_prefilter.Sources import source_classes
 from feta_prefilter.Filters import filter_classes
 from feta_prefilter.Outputs import output_classes
 
-from feta_prefilter.Filters.BaseFilter import FilterAction
-
 logger = logging.getLogger(__name__)
 
 
@@ -23,52 +29,56 @@ def main():
     config = init_config()
     logging.basicConfig(level=os.environ.get("DOMAINRADAR_LOG_LEVEL", "INFO"))
 
-    sources, filters, outputs = create_app(config)
+    app = create_app(config)
+    pipeline_config = app.dynamic_config.get("pipeline", {})
+    checkpoint_config = pipeline_config.get("checkpoint", {})
+    runner = PipelineRunner(
+        app,
+        queue_size=pipeline_config.get("queue_size", 16),
+        max_batch_size=pipeline_config.get("max_batch_size", 100_000),
+        deduplicator=Deduplicator.from_config(pipeline_config["dedup"]) if "dedup" in pipeline_config else None,
+        checkpoints=create_checkpoint_store(checkpoint_config, config) if checkpoint_config else None,
+        checkpoint_interval_s=checkpoint_config.get("interval_s", 5.0),
+    )
+    runner.start()
+    start_metrics(pipeline_config.get("metrics", {}), config)
 
-    while True:
-        if update_config(config):
-            sources, filters, outputs = create_app(config)
-
-        domains = set()
-        for s in sources:
-            domains.update(d.lower() for d in s.collect())
-
-        filter_results = {}
-        for f in filters:
-            filter_results[f] = f.filter(domains)
-        ###
-        # filter_results[f1] = [PASS, DROP, PASS...]
-        # filter_results[f2] = [DROP, PASS, PASS...]
-
-        ###
-        # transform into:
-        # [
-        #   { domain, f_results= {f1: PASS, f2: DROP} }
-        #   { domain, f_results= {f1: DROP, f2: PASS} }
-        #   { domain, f_results= {f1: PASS, f2: PASS} }
-        # ]
-        filtered_domains = []
-        for i, domain in enumerate(domains):
-            domain_results = {
-                f.filter_name: filter_results[f][i]
-                for f in filter_results.keys()
-            }
-            max_domain_result = max(domain_results.values())
-            if max_domain_result == FilterAction.DROP:
-                continue
-            elif max_domain_result == FilterAction.STORE:
-                filtered_domains.append({"domain": domain, "f_results": domain_results})
-            else:
-                # if all are PASS-analyze, then we don't need to store the json
-                filtered_domains.append(
-                    {
-                        "domain": domain,
-                        "f_results": {},
-                    }
-                )
+    # changed modules are built in the background while the current app keeps running
+    app_builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="app-builder")
+    next_app = None
+    reconfigure = False
 
-        for o in outputs:
-            o.output(filtered_domains)
+    config_poll_interval_ms = pipeline_config.get("config_poll_interval_ms", 1000)
+    while True:
+        # blocks until a config change request arrives, polls faster while a new app is being built
+        if update_config(config, timeout_ms=config_poll_interval_ms if next_app is None else 100):
+            reconfigure = True
+
+        if next_app is not None and next_app.done():
+            try:
+                previous_app, app = app, next_app.result()
+                runner.switch(app)
+                close_removed_filters(previous_app, app)
+                logger.info("Switched to the new configuration")
+                profile_config = pipeline_setting(app, "profile")
+                if profile_config and profile_config != pipeline_setting(previous_app, "profile"):
+                    start_profile(profile_config)
+            except Exception:
+                logger.exception("Failed to apply the new configuration")
+            next_app = None
+
+        if reconfigure and next_app is None:
+            next_app = app_builder.submit(create_app, dict(config), app)
+            reconfigure = False
+
+
+def start_metrics(metrics_config: dict, config: dict):
+    if "http_port" in metrics_config:
+        start_http_server(metrics_config["http_port"], metrics_config.get("http_host", "127.0.0.1"))
+    if "kafka_topic" in metrics_config:
+        start_kafka_publisher(
+            config["kafka_producer"], metrics_config["kafka_topic"], metrics_config.get("interval_s", 60.0)
+        )
 
 
 def init_config() -> dict:
@@ -127,17 +137,18 @@ def init_config() -> dict:
         bootstrap_servers=config["kafka_broker"],
         security_protocol="SSL",
         ssl_context=make_ssl_context(Path(config["kafka_secrets_dir"])),
-        consumer_timeout_ms=500,
     )
 
     update_config(config)
     return config
 
 
-def update_config(config: dict) -> bool:
+def update_config(config: dict, timeout_ms: int = 500) -> bool:
+    """Waits up to `timeout_ms` for configuration change requests and applies them."""
     changed = False
     consumer = config["kafka_consumer"]
-    for msg in consumer:
+    records = consumer.poll(timeout_ms=timeout_ms)
+    for msg in (msg for partition_records in records.values() for msg in partition_records):
         logger.debug(msg)
         if msg.key is None:
             continue
@@ -184,55 +195,109 @@ def notify_config_change(success: bool, config: dict, message: str = None):
     return
 
 
-def create_app(config: dict):
-    sources = []
-    for source in config["dynamic_config"]["sources"]:
-        source_cls_name = source["type"]
-        if source_cls_name not in source_classes:
-            logger.error(f"Unknown source class type {source_cls_name}")
-            continue
+class App:
+    """Module instances built from one dynamic configuration."""
 
-        try:
-            source_cls = source_classes[source_cls_name]
-            source_obj = source_cls(*source["args"], **source["kwargs"])
-        except:
-            logger.exception(f"Failed source initialization")
-            continue
+    def __init__(self, dynamic_config: dict):
+        self.dynamic_config = dynamic_config
+        self.sources = []
+        self.filters = []
+        self.outputs = []
+        self.pipeline: FilterPipeline | None = None
+        # module instances keyed by their config block, used to reuse them on reconfiguration
+        self.modules: dict[str, dict[str, list]] = {"sources": {}, "filters": {}, "outputs": {}}
+        # keys under which the cursors of the sources are checkpointed
+        self.checkpoint_keys: dict[object, str] = {}
 
-        sources.append(source_obj)
 
-    filters = []
-    for f in config["dynamic_config"]["filters"]:
-        filter_cls_name = f["type"]
-        if filter_cls_name not in filter_classes:
-            logger.error(f"Unknown filter class type {filter_cls_name}")
-            continue
+def config_block_key(block: dict) -> str:
+    return json.dumps([block["type"], block["args"], block["kwargs"]], sort_keys=True)
 
-        try:
-            filter_cls = filter_classes[filter_cls_name]
-            filter_obj = filter_cls(*f["args"], **f["kwargs"])
-        except:
-            logger.exception(f"Failed filter initialization")
-            continue
 
-        filters.append(filter_obj)
+def checkpoint_key(block: dict, key: str, n: int) -> str:
+    """Identifies the n-th source of a config block without exposing its arguments."""
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return f"{block['type']}:{digest}:{n}"
 
-    outputs = []
-    for output in config["dynamic_config"]["outputs"]:
-        output_cls_name = output["type"]
-        if output_cls_name not in output_classes:
-            logger.error(f"Unknown output class type {output_cls_name}")
-            continue
 
-        try:
-            output_cls = output_classes[output_cls_name]
-            output_obj = output_cls(*output["args"], **output["kwargs"])
-        except:
-            logger.exception(f"Failed output initialization")
-            continue
+def create_module(block: dict, module_classes: dict, kind: str):
+    cls_name = block["type"]
+    if cls_name not in module_classes:
+        logger.error(f"Unknown {kind} class type {cls_name}")
+        return None
 
-        outputs.append(output_obj)
-    return sources, filters, outputs
+    try:
+        module_cls = module_classes[cls_name]
+        return module_cls(*block["args"], **block["kwargs"])
+    except:
+        logger.exception(f"Failed {kind} initialization")
+        return None
+
+
+def create_app(config: dict, previous: App | None = None) -> App:
+    """Creates the modules of the dynamic configuration.
+
+    Modules of the previous app whose type, args and kwargs did not change are
+    reused as they are, only new or changed config blocks are instantiated.
+    """
+    dynamic_config = config["dynamic_config"]
+    app = App(dynamic_config)
+    for kind, module_classes, modules in (
+        ("sources", source_classes, app.sources),
+        ("filters", filter_classes, app.filters),
+        ("outputs", output_classes, app.outputs),
+    ):
+        reusable = {}
+        if previous is not None:
+            reusable = {key: list(objs) for key, objs in previous.modules[kind].items()}
+
+        for block in dynamic_config[kind]:
+            key = config_block_key(block)
+            if reusable.get(key):
+                module_obj = reusable[key].pop(0)
+                logger.debug(f"Reusing {kind} module {block['type']}")
+            else:
+                module_obj = create_module(block, module_classes, kind[:-1])
+                if module_obj is None:
+                    continue
+            modules.append(module_obj)
+            same_block = app.modules[kind].setdefault(key, [])
+            same_block.append(module_obj)
+            if kind == "sources":
+                app.checkpoint_keys[module_obj] = checkpoint_key(block, key, len(same_block) - 1)
+
+    pipeline_config = dynamic_config.get("pipeline", {})
+    if (
+        previous is not None
+        and previous.pipeline is not None
+        and previous.filters == app.filters
+        and without_runtime_settings(previous.dynamic_config.get("pipeline", {}))
+        == without_runtime_settings(pipeline_config)
+    ):
+        app.pipeline = previous.pipeline
+    else:
+        app.pipeline = FilterPipeline(
+            app.filters,
+            short_circuit=pipeline_config.get("short_circuit", False),
+            workers=pipeline_config.get("filter_workers", 0),
+        )
+        app.pipeline.build_index()
+    return app
+
+
+def pipeline_setting(app: App, key: str):
+    return app.dynamic_config.get("pipeline", {}).get(key)
+
+
+def without_runtime_settings(pipeline_config: dict) -> dict:
+    """Drops the pipeline settings that do not require a new pipeline."""
+    return {key: value for key, value in pipeline_config.items() if key != "profile"}
+
+
+def close_removed_filters(previous: App, app: App) -> None:
+    for f in previous.filters:
+        if f not in app.filters:
+            f.close()
 
 
 def validate_dynamic_config(change_request):
@@ -243,6 +308,7 @@ def validate_dynamic_config(change_request):
             validate_config_block(f)
         for output in change_request["outputs"]:
             validate_config_block(output)
+        validate_pipeline_config(change_request.get("pipeline", {}))
     except:
         logger.exception(f"Failed validation of config change request {change_request}")
         return False
@@ -256,5 +322,9 @@ def validate_config_block(block: dict):
     block["kwargs"]
 
 
+def validate_pipeline_config(pipeline: dict):
+    assert isinstance(pipeline, dict), "pipeline must be an object"
+
+
 if __name__ == "__main__":
     main()
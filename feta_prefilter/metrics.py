@@ -0,0 +1,199 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS_S = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_S) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(LATENCY_BUCKETS_S, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Registry of the loader metrics.
+
+    Counters and histograms are updated by the stages as they go, gauges are
+    either set directly or computed by a callback when the metrics are read.
+    Every metric is identified by its name and labels, the values can be
+    rendered in the Prometheus text format or taken as a JSON-serializable
+    snapshot.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: dict[str, tuple[str, str]] = {}
+        self._values: dict[str, dict[tuple, float | _Histogram]] = {}
+        self._callbacks: dict[str, Callable[[], dict[tuple, float]]] = {}
+
+    def describe(self, name: str, metric_type: str, help_text: str) -> None:
+        self._help[name] = (metric_type, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values.setdefault(name, {})[key] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            histogram = values.get(key)
+            if histogram is None:
+                histogram = values[key] = _Histogram()
+            histogram.observe(value)
+
+    def register_callback(self, name: str, callback: Callable[[], dict[tuple, float]]) -> None:
+        """Computes the gauge `name` when the metrics are read, the callback maps label tuples to values."""
+        with self._lock:
+            self._callbacks[name] = callback
+
+    def unregister_callback(self, name: str) -> None:
+        with self._lock:
+            self._callbacks.pop(name, None)
+
+    def _collect(self) -> dict[str, dict[tuple, float | _Histogram]]:
+        with self._lock:
+            collected = {name: dict(values) for name, values in self._values.items()}
+            callbacks = list(self._callbacks.items())
+        for name, callback in callbacks:
+            try:
+                collected[name] = callback()
+            except Exception:
+                logger.exception("Metric callback %s failed", name)
+        return collected
+
+    def render(self) -> str:
+        """Renders the metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, values in sorted(self._collect().items()):
+            metric_type, help_text = self._help.get(name, (GAUGE, ""))
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for key, value in values.items():
+                if isinstance(value, _Histogram):
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS_S + (float("inf"),), value.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{_labels(key + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(key)} {value.sum}")
+                    lines.append(f"{name}_count{_labels(key)} {value.count}")
+                else:
+                    lines.append(f"{name}{_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Returns the metrics as a JSON-serializable dict, histograms as their count and sum."""
+        res = {}
+        for name, values in self._collect().items():
+            samples = []
+            for key, value in values.items():
+                sample = {"labels": dict(key)}
+                if isinstance(value, _Histogram):
+                    sample["count"] = value.count
+                    sample["sum"] = value.sum
+                else:
+                    sample["value"] = value
+                samples.append(sample)
+            res[name] = samples
+        return res
+
+
+def _labels(key: tuple) -> str:
+    if not key:
+        return ""
+    parts = []
+    for name, value in key:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+metrics = Metrics()
+
+metrics.describe("prefilter_source_collect_seconds", HISTOGRAM, "Time of one collect call of a source.")
+metrics.describe("prefilter_source_domains_total", COUNTER, "Domains collected by a source.")
+metrics.describe("prefilter_source_errors_total", COUNTER, "Failed collect calls of a source.")
+metrics.describe("prefilter_filter_seconds_total", COUNTER, "Time spent evaluating a filter.")
+metrics.describe("prefilter_filter_actions_total", COUNTER, "Filter verdicts by action.")
+metrics.describe("prefilter_filter_index_bytes", GAUGE, "Approximate memory used by the suffix index of a filter.")
+metrics.describe("prefilter_batch_domains_total", COUNTER, "Domains passed through the filter stage.")
+metrics.describe("prefilter_batch_verdicts_total", COUNTER, "Final verdicts of the filter stage by action.")
+metrics.describe("prefilter_filter_stage_seconds", HISTOGRAM, "Time of one iteration of the filter stage.")
+metrics.describe("prefilter_output_seconds", HISTOGRAM, "Time of one output call of an output.")
+metrics.describe("prefilter_output_domains_total", COUNTER, "Domains an output processed without an error.")
+metrics.describe("prefilter_output_rows_total", COUNTER, "Domains reported as written by an output.")
+metrics.describe("prefilter_output_errors_total", COUNTER, "Failed output calls of an output.")
+metrics.describe("prefilter_output_dropped_batches_total", COUNTER, "Batches an output was given up on.")
+metrics.describe("prefilter_output_stage_seconds", HISTOGRAM, "Time of one iteration of the output stage.")
+metrics.describe("prefilter_queue_depth", GAUGE, "Batches waiting in a queue between the stages.")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serves the metrics on ``http://host:port/metrics`` from a background thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return server
+
+
+def start_kafka_publisher(producer, topic: str, interval_s: float = 60.0) -> threading.Thread:
+    """Publishes a JSON snapshot of the metrics to the Kafka topic every `interval_s`."""
+
+    def publish():
+        while True:
+            time.sleep(interval_s)
+            try:
+                msg = {"timestamp": time.time(), "metrics": metrics.snapshot()}
+                producer.send(topic, key="loader".encode(), value=json.dumps(msg).encode())
+            except Exception:
+                logger.exception("Failed to publish metrics")
+
+    thread = threading.Thread(target=publish, name="metrics-kafka", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,118 @@
+import re
+from typing import Iterable, Mapping
+from urllib.parse import urlsplit
+
+# mirrors validators.domain on the IDNA-encoded name, plus the 253 characters limit of RFC 1035
+_VALID_DOMAIN = re.compile(
+    r"(?:[a-z0-9](?:[a-z0-9-_]{0,61}[a-z0-9])?\.)+[a-z0-9][a-z0-9-_]{0,61}[a-z]"
+)
+MAX_DOMAIN_LENGTH = 253
+
+
+class NormalizedBatch:
+    """Normalized, unique domain names of one batch.
+
+    `domains` holds the normalized names, `labels` their labels ordered from
+    the TLD down and `valid` whether each name is a syntactically valid domain.
+    `counts` holds how many times each name occurred in the batch, if known.
+    Filters and outputs work on this representation, so every name is parsed
+    only once per batch.
+
+    The batch is frozen: the columns are tuples and cannot be replaced, so a
+    position identifies the same name in every column for the lifetime of the
+    batch. Filter results refer to the names by these positions.
+    """
+
+    __slots__ = ("domains", "labels", "valid", "counts")
+
+    def __init__(
+        self,
+        domains: tuple[str, ...],
+        labels: tuple[tuple[str, ...], ...],
+        valid: tuple[bool, ...],
+        counts: tuple[int, ...] | None = None,
+    ):
+        object.__setattr__(self, "domains", tuple(domains))
+        object.__setattr__(self, "labels", tuple(labels))
+        object.__setattr__(self, "valid", tuple(valid))
+        object.__setattr__(self, "counts", tuple(counts) if counts is not None else None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self):
+        # shards are pickled to the filter worker processes
+        return NormalizedBatch, (self.domains, self.labels, self.valid, self.counts)
+
+    def __len__(self) -> int:
+        return len(self.domains)
+
+    def slice(self, start: int, stop: int) -> "NormalizedBatch":
+        return NormalizedBatch(
+            self.domains[start:stop],
+            self.labels[start:stop],
+            self.valid[start:stop],
+            self.counts[start:stop] if self.counts is not None else None,
+        )
+
+    def take(self, positions: list[int]) -> "NormalizedBatch":
+        return NormalizedBatch(
+            [self.domains[i] for i in positions],
+            [self.labels[i] for i in positions],
+            [self.valid[i] for i in positions],
+            [self.counts[i] for i in positions] if self.counts is not None else None,
+        )
+
+
+def normalize_domain(domain: str) -> str:
+    """Lowercases the name, takes the host of URLs, drops the root dot and IDNA-encodes it."""
+    domain = domain.strip().lower()
+    if "/" in domain:
+        # urlsplit needs the scheme separator to recognize the host
+        host = urlsplit(domain if "//" in domain else f"//{domain}").hostname
+        if host:
+            domain = host
+    if domain.endswith(".") and len(domain) > 1:
+        domain = domain[:-1]
+    if not domain.isascii():
+        try:
+            domain = domain.encode("idna").decode("ascii")
+        except UnicodeError:
+            # left as it is, such a name is reported as invalid
+            pass
+    return domain
+
+
+def normalize_batch(domains: Iterable[str] | Mapping[str, int]) -> NormalizedBatch:
+    """Normalizes and deduplicates the domains in one pass.
+
+    The names keep the order of their first occurrence, so the batch does not
+    depend on how the iterable orders its items beyond that. When the domains
+    are given as a mapping to their occurrence counts, the counts of names that
+    normalize to the same name are summed up. Names that normalize to an empty
+    string are dropped.
+    """
+    valid_domain = _VALID_DOMAIN.fullmatch
+    source_counts = domains if isinstance(domains, Mapping) else None
+    positions = {}
+    names = []
+    labels = []
+    valid = []
+    counts = [] if source_counts is not None else None
+    for domain in domains:
+        name = normalize_domain(domain)
+        if not name:
+            # e.g. the host of a URL without a scheme, nothing to filter or output
+            continue
+        i = positions.get(name)
+        if i is not None:
+            if counts is not None:
+                counts[i] += source_counts[domain]
+            continue
+        positions[name] = len(names)
+        names.append(name)
+        labels.append(tuple(reversed(name.split("."))))
+        valid.append(len(name) <= MAX_DOMAIN_LENGTH and valid_domain(name) is not None)
+        if counts is not None:
+            counts.append(source_counts[domain])
+    return NormalizedBatch(names, labels, valid, counts)
@@ -0,0 +1,483 @@
+import logging
+import multiprocessing
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import threading
+import time
+from array import array
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Mapping
+
+from feta_prefilter.Filters.BaseFilter import BaseFilter, FilterAction, IndexExtension
+from feta_prefilter.Filters.SharedSuffixIndex import SharedSuffixIndex, write_shared_index
+from feta_prefilter.Filters.SuffixIndex import SuffixIndex, SuffixIndexBuilder
+from feta_prefilter import profiler
+from feta_prefilter.batch import DomainBatch
+from feta_prefilter.metrics import metrics
+from feta_prefilter.normalize import NormalizedBatch, normalize_batch
+
+logger = logging.getLogger(__name__)
+
+# every fused filter owns one bit of the 64-bit suffix index tags
+MAX_FUSED_FILTERS = 64
+# batches smaller than this are not worth sending to the worker processes
+MIN_SHARD_SIZE = 1000
+
+# pipeline of a filter worker process, unpickled from the state sent by the main process
+_worker_pipeline: "FilterPipeline | None" = None
+# combined index mapped by the worker process, switched when the main process publishes a new one
+_worker_index: SharedSuffixIndex | None = None
+
+
+def _init_worker(state: bytes) -> None:
+    global _worker_pipeline
+    # workers forked from the fork server start with the same random state
+    random.seed()
+    _worker_pipeline = FilterPipeline.from_worker_state(state)
+
+
+def _evaluate_shard(shard: tuple[str, NormalizedBatch]) -> tuple[DomainBatch, "EvaluationStats"]:
+    global _worker_index
+    index_path, batch = shard
+    if _worker_index is None or _worker_index.path != index_path:
+        if _worker_index is not None:
+            _worker_index.close()
+        _worker_index = SharedSuffixIndex(index_path)
+        _worker_pipeline._combined = (_worker_index, _worker_pipeline._combined[1])
+    stats = EvaluationStats()
+    return _worker_pipeline._evaluate(batch, stats), stats
+
+
+def is_suffix_filter(f: BaseFilter) -> bool:
+    """Whether the filter's verdict comes only from its suffix index."""
+    return type(f).filter is BaseFilter.filter
+
+
+class _FusedFilter(BaseFilter):
+    """Stands in for a fused suffix filter in the worker processes, which only need its name and action."""
+
+
+class FilterStats:
+    """Moving averages of the cost and drop rate of a filter."""
+
+    __slots__ = ("cost_per_domain", "drop_rate")
+
+    # weight of the latest batch in the moving averages
+    ALPHA = 0.2
+
+    def __init__(self):
+        self.cost_per_domain = 0.0
+        self.drop_rate = 0.0
+
+    def update(self, elapsed: float, evaluated: int, dropped: int) -> None:
+        if not evaluated:
+            return
+        self.cost_per_domain += self.ALPHA * (elapsed / evaluated - self.cost_per_domain)
+        self.drop_rate += self.ALPHA * (dropped / evaluated - self.drop_rate)
+
+    @property
+    def rank(self) -> float:
+        """Expected cost of dropping a domain, cheap filters with high drop rates come first."""
+        return self.cost_per_domain / max(self.drop_rate, 1e-6)
+
+
+class EvaluationStats:
+    """Time spent in the filters and their verdicts over a batch, merged over its shards."""
+
+    # label of the time of the lookups in the combined suffix index, shared by all suffix filters
+    SUFFIX_INDEX = "suffix_index"
+
+    def __init__(self):
+        self.filter_seconds: dict[str, float] = {}
+        self.filter_actions: dict[str, Counter] = {}
+        self.verdicts = Counter()
+
+    def add_time(self, name: str, seconds: float) -> None:
+        self.filter_seconds[name] = self.filter_seconds.get(name, 0.0) + seconds
+
+    def add_actions(self, name: str, actions: Mapping[FilterAction, int]) -> None:
+        self.filter_actions.setdefault(name, Counter()).update(actions)
+
+    def merge(self, other: "EvaluationStats") -> None:
+        for name, seconds in other.filter_seconds.items():
+            self.add_time(name, seconds)
+        for name, actions in other.filter_actions.items():
+            self.add_actions(name, actions)
+        self.verdicts.update(other.verdicts)
+
+    def record(self) -> None:
+        for name, seconds in self.filter_seconds.items():
+            metrics.inc("prefilter_filter_seconds_total", seconds, filter=name)
+        for name, actions in self.filter_actions.items():
+            for action, count in actions.items():
+                metrics.inc("prefilter_filter_actions_total", count, filter=name, action=FilterAction(action).name)
+        for action, count in self.verdicts.items():
+            metrics.inc("prefilter_batch_verdicts_total", count, action=FilterAction(action).name)
+        metrics.inc("prefilter_batch_domains_total", sum(self.verdicts.values()))
+
+
+class FilterPipeline:
+    """Evaluates all filters over a batch of domains in a single pass.
+
+    The suffix indexes of the suffix filters are merged into one combined index
+    where every entry is tagged with the bits of the filters it belongs to, so
+    each domain is walked only once regardless of the number of blocklists.
+    Filters with custom `filter` logic are evaluated through `filter_sparse`,
+    so only the domains they do not PASS are visited when merging the results.
+
+    With `short_circuit` enabled, the custom filters that can only DROP are
+    evaluated one after another on the domains that have not been dropped yet,
+    ordered by their measured cost per domain and drop rate. Filters that can
+    STORE still see every domain, since a STORE verdict overrides a DROP and
+    needs the results of all filters, so the output is the same in both modes.
+
+    With `workers` greater than 1, large batches are split into contiguous
+    shards evaluated by a pool of worker processes and the results are joined
+    in order. The workers are started once from a fork server, never forked
+    from the threaded main process, and receive the pickled custom filters;
+    snapshots are mapped again by path and shared in the page cache. The
+    combined index is written to a file in shared memory that all workers map,
+    see `SharedSuffixIndex`. When it changes a new file is written in the
+    background and published with the next batches, until then the workers
+    keep using the previous one. Custom filters that cannot be pickled are
+    evaluated in the main process.
+
+    The combined index is rebuilt by the thread that swaps in a new suffix
+    index of a filter, e.g. the refresh thread of a `RefreshingFilter`, so the
+    batches keep being evaluated with the previous combined index meanwhile.
+    """
+
+    def __init__(self, filters: list[BaseFilter], short_circuit: bool = False, workers: int = 0):
+        self.filters = filters
+        self.short_circuit = short_circuit
+        self.workers = workers
+        self.suffix_filters = [f for f in filters if is_suffix_filter(f)][:MAX_FUSED_FILTERS]
+        self.dense_filters = [f for f in filters if f not in self.suffix_filters]
+        self._bits = {f: bit for bit, f in enumerate(self.suffix_filters)}
+        self.filter_names = tuple(f.filter_name for f in filters)
+        self._stats = {f: FilterStats() for f in self.dense_filters}
+
+        # the combined index and the filter indexes it was built from, replaced as a whole
+        self._combined: tuple[SuffixIndex, list[SuffixIndex]] = (SuffixIndex(), [])
+        self._combined_lock = threading.Lock()
+        # the verdict of a tag depends only on the actions of the filters, not on their lists
+        self._tag_verdicts = {0: FilterAction.PASS}
+
+        self._pool = None
+        # the filters could not be sent to the workers
+        self._pool_failed = False
+        # combined index that could not be written for the workers, evaluated in the main process
+        self._unshared_index: SuffixIndex | None = None
+        # path of the combined index file mapped by the workers and the index it was written from
+        self._shared: tuple[str, SuffixIndex] | None = None
+        # combined index file written in the background for a changed combined index
+        self._next_shared: Future | None = None
+        self._publisher: ThreadPoolExecutor | None = None
+        self._shared_dir: str | None = None
+
+        for f in self.suffix_filters:
+            f.add_index_listener(self._on_index_swap)
+
+    def close(self) -> None:
+        """Stops the worker processes and the rebuilds of the combined index."""
+        for f in self.suffix_filters:
+            f.remove_index_listener(self._on_index_swap)
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        if self._publisher is not None:
+            # a file being written would be left behind in the removed directory
+            self._publisher.shutdown(wait=True)
+            self._next_shared = None
+        if self._shared_dir is not None:
+            shutil.rmtree(self._shared_dir, ignore_errors=True)
+            self._shared_dir = None
+            self._shared = None
+
+    def _ensure_pool(self):
+        """Returns the pool and the path of the combined index file to evaluate the batch with, which is the
+        previous one while the current one is written, None if the filters cannot be sent to the workers."""
+        if self._pool_failed:
+            return None
+
+        combined_index = self._current_combined()[0]
+        if self._next_shared is not None and self._next_shared.done():
+            published = self._next_shared.result()
+            self._next_shared = None
+            if published is not None:
+                # the workers switch to the new file with the next batch, they keep their mapping of the old one
+                os.unlink(self._shared[0])
+                self._shared = published
+
+        if combined_index is self._unshared_index:
+            return None
+        if self._shared is None:
+            self._shared = self._publish(combined_index)
+            if self._shared is None:
+                return None
+        elif self._shared[1] is not combined_index and self._next_shared is None:
+            if self._publisher is None:
+                self._publisher = ThreadPoolExecutor(1, thread_name_prefix="filter-index")
+            self._next_shared = self._publisher.submit(self._publish, combined_index)
+
+        if self._pool is None:
+            try:
+                state = self.worker_state()
+            except Exception:
+                logger.exception("Cannot send the filters to the worker processes, filtering in the main process")
+                self._pool_failed = True
+                return None
+            self._pool = multiprocessing.get_context("forkserver").Pool(
+                self.workers, initializer=_init_worker, initargs=(state,)
+            )
+            logger.info("Started %d filter worker processes", self.workers)
+        return self._pool, self._shared[0]
+
+    def _publish(self, combined_index: SuffixIndex) -> tuple[str, SuffixIndex] | None:
+        """Writes the combined index into a new file for the workers to map."""
+        try:
+            if self._shared_dir is None:
+                # tmpfs keeps the file in memory, the workers map its pages without any disk reads
+                shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+                self._shared_dir = tempfile.mkdtemp(prefix="prefilter-index-", dir=shm)
+            fd, path = tempfile.mkstemp(suffix=".idx", dir=self._shared_dir)
+            os.close(fd)
+            write_shared_index(path, combined_index)
+        except Exception:
+            logger.exception(
+                "Cannot share the combined suffix index with the worker processes, filtering in the main process"
+            )
+            self._unshared_index = combined_index
+            return None
+        logger.info("Shared combined suffix index of %d entries with the worker processes", len(combined_index))
+        return path, combined_index
+
+    def worker_state(self) -> bytes:
+        """Pickles what the worker processes need to evaluate the filters.
+
+        The fused suffix filters are sent only as their names and actions, the
+        combined index is mapped by the workers, see `SharedSuffixIndex`, and the
+        custom filters are pickled as they are.
+        """
+        fused = {f: _FusedFilter(f.filter_name, f.filter_result_action) for f in self.suffix_filters}
+        filters = [fused.get(f, f) for f in self.filters]
+        return pickle.dumps((filters, self.short_circuit, self._stats), pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_worker_state(cls, state: bytes) -> "FilterPipeline":
+        """Builds the pipeline of a worker process from `worker_state`."""
+        filters, short_circuit, filter_stats = pickle.loads(state)
+        pipeline = cls(filters, short_circuit)
+        pipeline._stats = filter_stats
+        # the stand-ins never swap their indexes, so the combined index is never rebuilt; the mapped
+        # index is set by `_evaluate_shard`
+        pipeline._combined = (SuffixIndex(), [f.suffix_index for f in pipeline.suffix_filters])
+        return pipeline
+
+    def build_index(self) -> None:
+        """Builds the combined suffix index ahead of the first batch."""
+        if self.suffix_filters:
+            self._rebuild_combined_index()
+
+    def index_memory_usage(self) -> int:
+        """Approximate number of bytes held by the combined suffix index."""
+        return self._combined[0].memory_usage()
+
+    def _on_index_swap(self, f: BaseFilter, extension: IndexExtension | None) -> None:
+        if extension is None or not self._extend_combined_index(f, extension):
+            self._rebuild_combined_index()
+
+    def _extend_combined_index(self, f: BaseFilter, extension: IndexExtension) -> bool:
+        """Adds the entries of the extended filter index to the combined index, False if it has to be rebuilt."""
+        with self._combined_lock:
+            combined_index, combined_sources = self._combined
+            bit = self._bits[f]
+            sources = [g.suffix_index for g in self.suffix_filters]
+            expected = list(sources)
+            expected[bit] = extension.previous
+            if len(combined_sources) != len(expected) or any(a is not b for a, b in zip(combined_sources, expected)):
+                return False
+            combined_index = combined_index.extended(extension.entries, 1 << bit)
+            self._combined = (combined_index, sources)
+        logger.info("Added %d entries of filter %s to the combined suffix index", len(extension.entries), f.filter_name)
+        return True
+
+    def _rebuild_combined_index(self) -> None:
+        with self._combined_lock:
+            sources = [f.suffix_index for f in self.suffix_filters]
+            combined_sources = self._combined[1]
+            if len(sources) == len(combined_sources) and all(a is b for a, b in zip(sources, combined_sources)):
+                return
+
+            builder = SuffixIndexBuilder()
+            for bit, index in enumerate(sources):
+                for labels, _ in index.entries():
+                    builder.add_labels(labels, 1 << bit)
+            combined_index = builder.build()
+            self._combined = (combined_index, sources)
+        logger.info("Built combined suffix index of %d filters with %d entries", len(sources), len(combined_index))
+
+    def _current_combined(self) -> tuple[SuffixIndex, list[SuffixIndex]]:
+        if self.suffix_filters and not self._combined[1]:
+            # not built ahead by `build_index`
+            self._rebuild_combined_index()
+        return self._combined
+
+    def _match_suffix_filters(self, batch: NormalizedBatch) -> dict[int, int]:
+        """Returns the tags of the domains matched by some suffix filter by their positions."""
+        return self._current_combined()[0].match_sparse(batch.labels)
+
+    def _tag_verdict(self, tag: int) -> FilterAction:
+        verdict = FilterAction.PASS
+        for bit, f in enumerate(self.suffix_filters):
+            if tag >> bit & 1 and f.filter_result_action > verdict:
+                verdict = f.filter_result_action
+        self._tag_verdicts[tag] = verdict
+        return verdict
+
+    def _results(self, tag: int, sparse_results: dict[BaseFilter, dict[int, FilterAction]], i: int) -> list[int]:
+        f_results = []
+        for f in self.filters:
+            if f in sparse_results:
+                f_results.append(sparse_results[f].get(i, FilterAction.PASS))
+            else:
+                bit = self._bits[f]
+                f_results.append(f.filter_result_action if tag >> bit & 1 else FilterAction.PASS)
+        return f_results
+
+    def run(self, domains: Iterable[str] | Mapping[str, int]) -> DomainBatch:
+        """Filters the domains and returns the ones that are not dropped.
+
+        A domain is dropped when the highest action of all filters is DROP. Domains
+        with a STORE verdict carry the results of every filter, passed domains carry
+        empty results, see `DomainBatch`. The domains are normalized first, see
+        `normalize_batch`. When the domains map to their occurrence counts, the
+        batch carries the counts as ``hits``.
+        """
+        batch = normalize_batch(domains)
+        for f in self.suffix_filters:
+            f.prepare()
+
+        pool_and_index = None
+        if self.workers > 1 and len(batch) >= 2 * MIN_SHARD_SIZE:
+            pool_and_index = self._ensure_pool()
+        if pool_and_index is not None:
+            pool, index_path = pool_and_index
+            shard_size = max(MIN_SHARD_SIZE, -(-len(batch) // self.workers))
+            shards = [(index_path, batch.slice(i, i + shard_size)) for i in range(0, len(batch), shard_size)]
+            shard_results = []
+            stats = EvaluationStats()
+            for shard_result, shard_stats in pool.map(_evaluate_shard, shards):
+                shard_results.append(shard_result)
+                stats.merge(shard_stats)
+            filtered_domains = DomainBatch.concat(shard_results)
+        else:
+            stats = EvaluationStats()
+            filtered_domains = self._evaluate(batch, stats)
+
+        stats.record()
+        if profiler.session is not None:
+            profiler.session.add_filter_stats(stats)
+        return filtered_domains
+
+    def _evaluate(self, batch: NormalizedBatch, stats: EvaluationStats) -> DomainBatch:
+        if self.suffix_filters:
+            start = time.perf_counter()
+            tags = self._match_suffix_filters(batch)
+            stats.add_time(EvaluationStats.SUFFIX_INDEX, time.perf_counter() - start)
+            self._count_suffix_actions(tags, len(batch), stats)
+        else:
+            tags = {}
+
+        # most domains match no suffix filter, only the matched ones are visited
+        verdicts = [FilterAction.PASS] * len(batch)
+        tag_verdicts = self._tag_verdicts
+        for i, tag in tags.items():
+            verdict = tag_verdicts.get(tag)
+            if verdict is None:
+                verdict = self._tag_verdict(tag)
+            verdicts[i] = verdict
+
+        if self.short_circuit:
+            sparse_results = self._evaluate_short_circuit(batch, verdicts, stats)
+        else:
+            sparse_results = {}
+            for f in self.dense_filters:
+                sparse_results[f] = self._evaluate_sparse(f, batch, verdicts, stats)
+
+        stats.verdicts.update(verdicts)
+        kept = [i for i, verdict in enumerate(verdicts) if verdict != FilterAction.DROP]
+        counts = batch.counts
+        filtered_domains = DomainBatch(
+            [batch.domains[i] for i in kept],
+            array("B", [verdicts[i] for i in kept]),
+            self.filter_names,
+            hits=array("q", [counts[i] for i in kept]) if counts is not None else None,
+        )
+        # if all are PASS-analyze, then we don't need to store the results
+        for row, i in enumerate(kept):
+            if verdicts[i] == FilterAction.STORE:
+                filtered_domains.set_results(row, self._results(tags.get(i, 0), sparse_results, i))
+        return filtered_domains
+
+    def _evaluate_sparse(
+        self, f: BaseFilter, batch: NormalizedBatch, verdicts: list, stats: EvaluationStats,
+        positions: list[int] | None = None,
+    ) -> dict[int, FilterAction]:
+        """Evaluates the filter on the domains at `positions` (all by default) and raises their verdicts.
+
+        Returns the actions of the domains that do not PASS by their positions in the batch.
+        """
+        start = time.perf_counter()
+        if positions is None:
+            evaluated = len(batch)
+            hits = dict(f.filter_sparse(batch))
+        else:
+            evaluated = len(positions)
+            hits = {positions[j]: action for j, action in f.filter_sparse(batch.take(positions))}
+        elapsed = time.perf_counter() - start
+
+        for i, action in hits.items():
+            if action > verdicts[i]:
+                verdicts[i] = action
+        self._stats[f].update(elapsed, evaluated, sum(1 for action in hits.values() if action))
+        stats.add_time(f.filter_name, elapsed)
+        actions = Counter(hits.values())
+        actions[FilterAction.PASS] += evaluated - len(hits)
+        stats.add_actions(f.filter_name, actions)
+        return hits
+
+    def _count_suffix_actions(self, tags: dict[int, int], evaluated: int, stats: EvaluationStats) -> None:
+        tag_counts = Counter(tags.values())
+        for bit, f in enumerate(self.suffix_filters):
+            matched = sum(count for tag, count in tag_counts.items() if tag >> bit & 1)
+            stats.add_actions(f.filter_name, {f.filter_result_action: matched, FilterAction.PASS: evaluated - matched})
+
+    def _evaluate_short_circuit(
+        self, batch: NormalizedBatch, verdicts: list, stats: EvaluationStats
+    ) -> dict[BaseFilter, dict[int, FilterAction]]:
+        sparse_results = {}
+        drop_filters = []
+        for f in self.dense_filters:
+            if f.filter_result_action > FilterAction.DROP:
+                sparse_results[f] = self._evaluate_sparse(f, batch, verdicts, stats)
+            else:
+                drop_filters.append(f)
+
+        drop_filters.sort(key=lambda f: self._stats[f].rank)
+        logger.debug("Short-circuit filter order: %s", [f.filter_name for f in drop_filters])
+
+        # dropped domains stay dropped unless a STORE filter matched, which has been evaluated already
+        pending = [i for i, verdict in enumerate(verdicts) if verdict != FilterAction.DROP]
+        for f in drop_filters:
+            if not pending:
+                sparse_results[f] = {}
+                continue
+            sparse_results[f] = self._evaluate_sparse(f, batch, verdicts, stats, pending)
+            pending = [i for i in pending if verdicts[i] != FilterAction.DROP]
+
+        return sparse_results
@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# the running profile, while it is None the stages skip all profiling work
+session: "ProfileSession | None" = None
+_session_lock = threading.Lock()
+
+
+class ProfileSession:
+    """Profiles the next `iterations` iterations of the filter stage.
+
+    A background thread samples the stacks of all threads every
+    `sample_interval_ms` and counts them in the collapsed format of
+    flamegraph.pl and speedscope. Meanwhile, the stages report the wall and CPU
+    time of every call of a module instance: `collect` of the sources, the
+    filter stage as a whole and `output` of the outputs. Filters only report
+    their wall time, their CPU time shows in the samples, unless they run in the
+    worker processes of the pipeline which are not sampled.
+
+    The session stops after `iterations` iterations or `max_duration_s`,
+    whichever comes first, and writes ``profile-<time>.folded`` with the
+    samples and ``profile-<time>.json`` with the module times to `output_dir`.
+    """
+
+    def __init__(
+        self,
+        iterations: int = 100,
+        output_dir: str = "profiles",
+        sample_interval_ms: float = 5.0,
+        max_duration_s: float = 300.0,
+    ):
+        assert iterations > 0, "iterations must be greater than 0"
+        assert sample_interval_ms > 0, "sample_interval_ms must be greater than 0"
+        self.iterations = iterations
+        self.output_dir = output_dir
+        self.sample_interval_s = sample_interval_ms / 1000
+        self.max_duration_s = max_duration_s
+
+        self._lock = threading.Lock()
+        self._stacks: Counter = Counter()
+        # calls, wall time and CPU time (None if not measured) by the kind and name of the module instance
+        self._modules: dict[tuple[str, str], list] = {}
+        self._done_iterations = 0
+        self._samples = 0
+        self._started = 0.0
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        global session
+        with _session_lock:
+            if session is not None:
+                logger.warning("A profile is already running, ignoring the new one")
+                return
+            session = self
+        self._started = time.monotonic()
+        threading.Thread(target=self._sample_loop, name="profiler", daemon=True).start()
+        logger.info("Profiling the next %d iterations", self.iterations)
+
+    def stop(self) -> None:
+        global session
+        with _session_lock:
+            if session is not self:
+                return
+            session = None
+        self._stopped.set()
+        try:
+            path = self.dump()
+            logger.info("Profile of %d iterations written to %s", self._done_iterations, path)
+        except Exception:
+            logger.exception("Failed to write the profile")
+
+    def add(self, kind: str, name: str, wall_s: float, cpu_s: float | None = None) -> None:
+        """Adds one call of a module instance."""
+        with self._lock:
+            totals = self._modules.setdefault((kind, name), [0, 0.0, None])
+            totals[0] += 1
+            totals[1] += wall_s
+            if cpu_s is not None:
+                totals[2] = (totals[2] or 0.0) + cpu_s
+
+    def add_filter_stats(self, stats) -> None:
+        """Adds the filter times of one `EvaluationStats`."""
+        for name, seconds in stats.filter_seconds.items():
+            self.add("filter", name, seconds)
+
+    def iteration_done(self) -> None:
+        with self._lock:
+            self._done_iterations += 1
+            done = self._done_iterations >= self.iterations
+        if done:
+            self.stop()
+
+    def dump(self) -> str:
+        """Writes the collected samples and module times, returns the path without the suffix."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, time.strftime("profile-%Y%m%d-%H%M%S"))
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+            modules = [
+                {"kind": kind, "name": name, "calls": calls, "wall_s": wall_s, "cpu_s": cpu_s}
+                for (kind, name), (calls, wall_s, cpu_s) in sorted(self._modules.items())
+            ]
+            summary = {
+                "iterations": self._done_iterations,
+                "duration_s": time.monotonic() - self._started,
+                "samples": self._samples,
+                "sample_interval_s": self.sample_interval_s,
+                "modules": modules,
+            }
+
+        with open(path + ".folded", "w") as f:
+            for stack, count in stacks:
+                f.write(f"{stack} {count}\n")
+        with open(path + ".json", "w") as f:
+            json.dump(summary, f, indent=2)
+        return path
+
+    def _sample_loop(self) -> None:
+        own_ident = threading.get_ident()
+        deadline = self._started + self.max_duration_s
+        while not self._stopped.wait(self.sample_interval_s):
+            if time.monotonic() >= deadline:
+                logger.warning("Profile reached max_duration_s before %d iterations", self.iterations)
+                self.stop()
+                return
+
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = [
+                _collapse(thread_names.get(ident, str(ident)), frame)
+                for ident, frame in sys._current_frames().items()
+                if ident != own_ident
+            ]
+            with self._lock:
+                self._stacks.update(stacks)
+                self._samples += 1
+
+
+def _collapse(thread_name: str, frame) -> str:
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    frames.append(thread_name)
+    return ";".join(reversed(frames))
+
+
+def instance_name(module_obj) -> str:
+    return f"{type(module_obj).__name__}@{id(module_obj):x}"
+
+
+def start_profile(profile_config: dict) -> None:
+    """Starts a profile with the settings of the ``profile`` pipeline setting."""
+    ProfileSession(
+        iterations=profile_config.get("iterations", 100),
+        output_dir=profile_config.get("output_dir", "profiles"),
+        sample_interval_ms=profile_config.get("sample_interval_ms", 5.0),
+        max_duration_s=profile_config.get("max_duration_s", 300.0),
+    ).start()
@@ -0,0 +1,395 @@
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+
+from feta_prefilter import profiler
+from feta_prefilter.metrics import metrics
+from feta_prefilter.pipeline import EvaluationStats
+
+logger = logging.getLogger(__name__)
+
+# how long blocked stages wait before checking whether they should stop
+POLL_INTERVAL_S = 0.5
+# first backoff delay after a poll of a source returned nothing or an output failed
+MIN_BACKOFF_S = 0.1
+# longest delay between the retries of a failed output
+MAX_RETRY_BACKOFF_S = 30.0
+# attempts to write a batch to an output before it is given up on, about a minute with the backoff
+MAX_OUTPUT_ATTEMPTS = 8
+
+
+def put_until_stopped(q: queue.Queue, item, stopped: threading.Event) -> bool:
+    """Blocks while the queue is full, returns False when stopped before the item was queued."""
+    while not stopped.is_set():
+        try:
+            q.put(item, timeout=POLL_INTERVAL_S)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def close_removed_outputs(previous: list, outputs: list) -> None:
+    for o in previous:
+        if o not in outputs:
+            try:
+                o.close()
+            except Exception:
+                logger.exception(f"Output {type(o).__name__} failed to close")
+
+
+class PollSchedule:
+    """Decides when a source is polled next.
+
+    A source that knows when it will have new domains tells so through
+    `next_ready`. Otherwise it is polled every `poll_interval_s` while it
+    returns domains and with an exponentially growing delay, capped at
+    `max_backoff_s`, while it returns nothing.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.backoff = 0.0
+
+    def next_delay(self, produced: bool) -> float:
+        interval = self.source.poll_interval_s
+        if produced:
+            self.backoff = 0.0
+        else:
+            self.backoff = min(max(self.backoff * 2, interval, MIN_BACKOFF_S), self.source.max_backoff_s)
+
+        next_ready = self.source.next_ready()
+        if next_ready is not None:
+            return max(0.0, next_ready - time.monotonic())
+        return interval if produced else self.backoff
+
+
+class SourceWorker(threading.Thread):
+    """Collects domains from one source and pushes the batches to the queue.
+
+    A batch maps the domains to the number of their occurrences, the filter
+    stage adds up the counts of coalesced batches. The batch also carries the
+    cursor of the source after collecting it, together with the `checkpoint_key`.
+
+    Between the polls the worker sleeps until the source is ready again, see
+    `PollSchedule`.
+    """
+
+    def __init__(self, source, batches: queue.Queue, checkpoint_key: str | None = None):
+        super().__init__(name=f"source-{type(source).__name__}", daemon=True)
+        self.source = source
+        self.batches = batches
+        self.checkpoint_key = checkpoint_key
+        self.schedule = PollSchedule(source)
+        self.stopped = threading.Event()
+
+    def run(self):
+        source_name = type(self.source).__name__
+        while not self.stopped.is_set():
+            profile = profiler.session
+            if profile is not None:
+                cpu_start = time.thread_time()
+            start = time.perf_counter()
+            try:
+                batch = self.source.collect_counts()
+            except Exception:
+                logger.exception(f"Source {source_name} failed to collect domains")
+                metrics.inc("prefilter_source_errors_total", source=source_name)
+                batch = {}
+            wall_s = time.perf_counter() - start
+            metrics.observe("prefilter_source_collect_seconds", wall_s, source=source_name)
+            if profile is not None:
+                profile.add("source", profiler.instance_name(self.source), wall_s, time.thread_time() - cpu_start)
+            metrics.inc("prefilter_source_domains_total", sum(batch.values()), source=source_name)
+
+            if batch:
+                cursors = {}
+                cursor = self.source.get_cursor()
+                if cursor is not None:
+                    cursors[self.source] = (self.checkpoint_key, cursor)
+                # a full queue pauses the source until the filter stage catches up
+                put_until_stopped(self.batches, (batch, cursors), self.stopped)
+
+            delay = self.schedule.next_delay(bool(batch))
+            if delay > 0:
+                self.stopped.wait(delay)
+
+        # the worker stops when its source was removed or the runner stopped
+        try:
+            self.source.close()
+        except Exception:
+            logger.exception(f"Source {source_name} failed to close")
+
+
+class PipelineRunner:
+    """Runs the sources, the filter pipeline and the outputs as concurrent stages.
+
+    Every source runs in its own worker thread and pushes its batches to a
+    bounded queue consumed by the filter stage, whose results go through a
+    second bounded queue to the output stage. When the outputs fall behind, the
+    full queues block the stages in front of them and eventually the sources.
+
+    An optional `Deduplicator` in the output stage keeps the recently emitted
+    domains away from the outputs. Domains count as emitted once all outputs
+    have processed their batch.
+
+    The cursors of the sources travel with their batches. Once all outputs
+    have processed a batch, the sources are told through `commit` and, with a
+    `CheckpointStore`, the cursors are stored at most every
+    `checkpoint_interval_s`. New sources are resumed from the stored cursors,
+    so a restart re-reads at most the batches that were in flight.
+
+    Failed outputs are retried with a growing delay, so the cursors never
+    move past a batch that was not written. An output is given up on after
+    `MAX_OUTPUT_ATTEMPTS` or right away when its error cannot be fixed by
+    retrying, see `BaseOutput.is_retryable`. Such a batch, and a batch that
+    fails to be filtered or deduplicated, is dropped and the cursors of its
+    sources are not committed anymore, so a restart replays it.
+    """
+
+    def __init__(
+        self,
+        app,
+        queue_size: int = 16,
+        max_batch_size: int = 100_000,
+        deduplicator=None,
+        checkpoints=None,
+        checkpoint_interval_s: float = 5.0,
+    ):
+        self.app = app
+        self.max_batch_size = max_batch_size
+        self.deduplicator = deduplicator
+        self.checkpoints = checkpoints
+        self.checkpoint_interval_s = checkpoint_interval_s
+        self.source_batches = queue.Queue(queue_size)
+        self.filtered_batches = queue.Queue(queue_size)
+
+        self._workers: dict[object, SourceWorker] = {}
+        # sources with a lost batch, their cursors stay at the last batch before it
+        self._held_sources = set()
+        self._stopped = threading.Event()
+        self._stages = [
+            threading.Thread(target=self._filter_stage, name="filter-stage", daemon=True),
+            threading.Thread(target=self._output_stage, name="output-stage", daemon=True),
+        ]
+        metrics.register_callback("prefilter_queue_depth", self._queue_depths)
+        metrics.register_callback("prefilter_filter_index_bytes", self._index_memory)
+
+    def start(self) -> None:
+        self._sync_source_workers()
+        for stage in self._stages:
+            stage.start()
+
+    def switch(self, app) -> None:
+        """Makes the stages use the modules of the new app from the next batch on."""
+        self.app = app
+        self._sync_source_workers()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        for worker in self._workers.values():
+            worker.stopped.set()
+        self._workers.clear()
+        if self.checkpoints is not None:
+            self.checkpoints.flush()
+
+    def _queue_depths(self) -> dict[tuple, float]:
+        return {
+            (("queue", "source_batches"),): self.source_batches.qsize(),
+            (("queue", "filtered_batches"),): self.filtered_batches.qsize(),
+        }
+
+    def _index_memory(self) -> dict[tuple, float]:
+        app = self.app
+        res = {(("filter", f.filter_name),): f.suffix_index.memory_usage() for f in app.filters}
+        res[(("filter", EvaluationStats.SUFFIX_INDEX),)] = app.pipeline.index_memory_usage()
+        if self.deduplicator is not None:
+            res[(("filter", "dedup_cache"),)] = self.deduplicator.cache.memory_usage()
+        return res
+
+    def _sync_source_workers(self) -> None:
+        sources = self.app.sources
+        for source in list(self._workers):
+            if source not in sources:
+                self._workers.pop(source).stopped.set()
+
+        for source in sources:
+            if source not in self._workers:
+                checkpoint_key = None
+                if self.checkpoints is not None:
+                    checkpoint_key = self.app.checkpoint_keys.get(source)
+                    self._restore_cursor(source, checkpoint_key)
+                worker = SourceWorker(source, self.source_batches, checkpoint_key)
+                self._workers[source] = worker
+                worker.start()
+
+    def _restore_cursor(self, source, checkpoint_key: str | None) -> None:
+        cursor = self.checkpoints.get(checkpoint_key) if checkpoint_key is not None else None
+        if cursor is None:
+            return
+        try:
+            source.set_cursor(cursor)
+            logger.info(f"Resumed source {type(source).__name__} from {cursor}")
+        except Exception:
+            logger.exception(f"Cannot resume source {type(source).__name__} from {cursor}")
+
+    def _hold(self, cursors: dict) -> None:
+        for source in cursors:
+            if source not in self._held_sources:
+                self._held_sources.add(source)
+                logger.error(
+                    f"Source {type(source).__name__} lost a batch, its cursor is not committed anymore "
+                    "so that the batch is replayed after a restart"
+                )
+
+    def _commit(self, cursors: dict) -> None:
+        checkpoints = {}
+        for source, (checkpoint_key, cursor) in cursors.items():
+            if source in self._held_sources:
+                continue
+            try:
+                source.commit(cursor)
+            except Exception:
+                logger.exception(f"Source {type(source).__name__} failed to commit {cursor}")
+            if checkpoint_key is not None:
+                checkpoints[checkpoint_key] = cursor
+        if self.checkpoints is not None:
+            self.checkpoints.update(checkpoints)
+
+    def _filter_stage(self) -> None:
+        pipeline = self.app.pipeline
+        while not self._stopped.is_set():
+            try:
+                batch, cursors = self.source_batches.get(timeout=POLL_INTERVAL_S)
+            except queue.Empty:
+                continue
+
+            profile = profiler.session
+            if profile is not None:
+                cpu_start = time.thread_time()
+            start = time.perf_counter()
+            # coalesce the batches that piled up while the previous one was being filtered
+            domains = Counter(batch)
+            cursors = dict(cursors)
+            while len(domains) < self.max_batch_size:
+                try:
+                    batch, batch_cursors = self.source_batches.get_nowait()
+                except queue.Empty:
+                    break
+                domains.update(batch)
+                # batches of one source are queued in order, the last cursor is the latest
+                cursors.update(batch_cursors)
+
+            if self.app.pipeline is not pipeline:
+                # the previous pipeline is only used by this stage, it is safe to stop its workers now
+                pipeline.close()
+                pipeline = self.app.pipeline
+
+            try:
+                filtered_domains = pipeline.run(domains)
+            except Exception:
+                logger.exception("Failed to filter a batch of domains")
+                self._hold(cursors)
+                continue
+
+            wall_s = time.perf_counter() - start
+            metrics.observe("prefilter_filter_stage_seconds", wall_s)
+            if profile is not None:
+                profile.add("stage", "filter", wall_s, time.thread_time() - cpu_start)
+                profile.iteration_done()
+            if filtered_domains or cursors:
+                put_until_stopped(self.filtered_batches, (filtered_domains, cursors), self._stopped)
+
+    def _output_stage(self) -> None:
+        outputs = self.app.outputs
+        next_checkpoint = time.monotonic() + self.checkpoint_interval_s
+        while not self._stopped.is_set():
+            if self.app.outputs is not outputs:
+                # the previous outputs are only used by this stage, it is safe to close the removed ones now
+                close_removed_outputs(outputs, self.app.outputs)
+                outputs = self.app.outputs
+
+            try:
+                filtered_domains, cursors = self.filtered_batches.get(timeout=POLL_INTERVAL_S)
+            except queue.Empty:
+                continue
+
+            stage_start = time.perf_counter()
+            if self.deduplicator is not None:
+                try:
+                    filtered_domains = self.deduplicator.process(filtered_domains)
+                except Exception:
+                    logger.exception("Failed to deduplicate a batch of domains")
+                    self._hold(cursors)
+                    continue
+            if self._output(outputs, filtered_domains):
+                if self.deduplicator is not None:
+                    # only the written domains are suppressed from now on
+                    self.deduplicator.commit(filtered_domains)
+                self._commit(cursors)
+            elif not self._stopped.is_set():
+                self._hold(cursors)
+            metrics.observe("prefilter_output_stage_seconds", time.perf_counter() - stage_start)
+            if self.checkpoints is None:
+                continue
+            now = time.monotonic()
+            if now >= next_checkpoint:
+                try:
+                    self.checkpoints.flush()
+                except Exception:
+                    logger.exception("Failed to store the source checkpoints")
+                next_checkpoint = now + self.checkpoint_interval_s
+
+    def _output(self, outputs: list, filtered_domains) -> bool:
+        """Writes the batch to the outputs, retrying the failed ones.
+
+        Returns False if an output was given up on or the runner stopped before
+        all outputs succeeded.
+        """
+        pending = list(outputs) if filtered_domains else []
+        backoff = 0.0
+        for attempt in range(1, MAX_OUTPUT_ATTEMPTS + 1):
+            failed = []
+            for o in pending:
+                error = self._write(o, filtered_domains)
+                if error is None:
+                    continue
+                if attempt == MAX_OUTPUT_ATTEMPTS or not o.is_retryable(error):
+                    logger.error(f"Dropping a batch of {len(filtered_domains)} domains for output "
+                                 f"{type(o).__name__} after {attempt} attempts")
+                    metrics.inc("prefilter_output_dropped_batches_total", output=type(o).__name__)
+                    return False
+                failed.append(o)
+            if not failed:
+                return True
+            backoff = min(max(backoff * 2, MIN_BACKOFF_S), MAX_RETRY_BACKOFF_S)
+            logger.warning(f"Retrying {len(failed)} failed outputs in {backoff:.1f}s")
+            if self._stopped.wait(backoff):
+                return False
+            # outputs removed by a configuration change meanwhile are not retried
+            pending = [o for o in failed if o in self.app.outputs]
+        return True
+
+    def _write(self, o, filtered_domains) -> Exception | None:
+        """Writes the batch to the output, returns the error it raised."""
+        output_name = type(o).__name__
+        profile = profiler.session
+        if profile is not None:
+            cpu_start = time.thread_time()
+        start = time.perf_counter()
+        error = None
+        try:
+            written = o.output(filtered_domains)
+            metrics.inc("prefilter_output_rows_total", len(written or ()), output=output_name)
+            metrics.inc("prefilter_output_domains_total", len(filtered_domains), output=output_name)
+        except Exception as e:
+            logger.exception(f"Output {output_name} failed")
+            metrics.inc("prefilter_output_errors_total", output=output_name)
+            error = e
+        wall_s = time.perf_counter() - start
+        metrics.observe("prefilter_output_seconds", wall_s, output=output_name)
+        if profile is not None:
+            profile.add("output", profiler.instance_name(o), wall_s, time.thread_time() - cpu_start)
+        return error
@@ -1,9 +1,16 @@
 import logging
+import os
 import ssl
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+def get_field(source: dict, path: str):
+    """Returns the value at the dotted path of nested dicts, e.g. ``dns.rrname``."""
+    for key in path.split("."):
+        source = source[key]
+    return source
+
 def password_loader(path: Path):
     def loader():
         with open(path) as f:
@@ -40,3 +47,15 @@ def make_ssl_context(path: Path) -> ssl.SSLContext | None:
                                 password=password_loader(path / "key-password.txt"))
 
     return ssl_context
+
+def kafka_options(bootstrap_servers: str | None = None, secrets_dir: str | None = None) -> dict:
+    """Connection options of Kafka clients, the loader's broker and secrets are used by default."""
+    bootstrap_servers = bootstrap_servers or os.environ.get("DOMAINRADAR_KAFKA_BROKER_URL", "")
+    secrets_dir = secrets_dir if secrets_dir is not None else os.environ.get("DOMAINRADAR_KAFKA_SECRETS_DIR", "")
+    if not secrets_dir:
+        return {"bootstrap_servers": bootstrap_servers}
+    return {
+        "bootstrap_servers": bootstrap_servers,
+        "security_protocol": "SSL",
+        "ssl_context": make_ssl_context(Path(secrets_dir)),
+    }